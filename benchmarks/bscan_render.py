@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Live B-scan display rate with synthetic complex B-scans, rendered offscreen.
+
+The first row is the previous display path: the dB image is computed with NumPy and the ImageView is cleared and given
+the new float image, which it rescales and histograms every frame. The second row is BScanViewer.update, which maps
+each complex pixel to 8-bit through a precomputed table of the dB window, into a preallocated buffer, and only replaces
+the image of the existing ImageItem. Each frame is repainted before the next one, so the rates include drawing the
+view.
+
+Usage, from the repository root:
+    python -m benchmarks.bscan_render --size 400 400 --frames 300
+"""
+
+import argparse
+import os
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+import pyqtgraph as PyQtG
+from PyQt5.QtWidgets import QApplication
+
+from src.main.python.PyImage.Widgets import BScanViewer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Live B-scan display rate')
+    parser.add_argument('--size', type=int, nargs=2, default=(400, 400), metavar=('Z', 'X'), help='B-scan size')
+    parser.add_argument('--frames', type=int, default=300, help='Frames per run')
+    args = parser.parse_args()
+
+    app = QApplication([])
+
+    shape = tuple(args.size)
+    bscans = ((np.random.randn(8, *shape) + 1j * np.random.randn(8, *shape)) * 10 ** -2).astype(np.complex64)
+
+    def previous(view, bscan):
+        view.clear()
+        view.setImage(20 * np.log10(np.abs(np.transpose(bscan))), autoLevels=False, levels=(-100, -2))
+
+    def current(view, bscan):
+        view.update(bscan)
+
+    old = PyQtG.ImageView()
+    old.ui.histogram.hide()
+    old.ui.roiBtn.hide()
+    old.ui.menuBtn.hide()
+
+    print('B-scans of ' + str(shape[0]) + ' x ' + str(shape[1]))
+    print('path       frames/s   ms/frame')
+    views = [('previous', old, previous), ('viewer', BScanViewer(), current)]
+    for name, view, draw in views:
+        view.resize(800, 800)
+        view.show()
+        for bscan in bscans:  # Warm up
+            draw(view, bscan)
+            view.repaint()
+            app.processEvents()
+        start = time.perf_counter()
+        for i in range(args.frames):
+            draw(view, bscans[i % len(bscans)])
+            view.repaint()
+            app.processEvents()
+        elapsed = time.perf_counter() - start
+        print(name.ljust(11) + str(round(args.frames / elapsed, 1)).ljust(11) +
+              str(round(1000 * elapsed / args.frames, 2)))
+        view.hide()
+
+    for name, view, draw in views:
+        view.deleteLater()
+    app.processEvents()
+
+
+if __name__ == '__main__':
+    main()
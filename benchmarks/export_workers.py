@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Export throughput against the number of processing worker threads, with synthetic raw figure-8s.
+
+Frames go through the same path as FigureEight.exportFrames: the background window is estimated on the dispatching
+thread and the reconstruction runs on an OrderedWorkerPool with the single-threaded kernels. The first row is the
+single-threaded dispatch with the parallel kernels, which is what export did before the worker pool.
+
+Usage, from the repository root:
+    python -m benchmarks.export_workers --frames 500 --alines 100
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from src.main.python.PyImage.Buffers import OrderedWorkerPool
+from src.main.python.PyImage.OCT import generateIdealFigureEightPositions, generateInterpolationTables, \
+    updateBackground8, updateBackground8Serial, reconstruct8
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export throughput against processing worker threads')
+    parser.add_argument('--frames', type=int, default=500, help='Figure-8s per run')
+    parser.add_argument('--alines', type=int, default=100, help='A-lines per B-scan, including padding')
+    parser.add_argument('--padding', type=int, default=20, help='B-scan padding')
+    parser.add_argument('--flyback', type=int, default=50, help='A-lines per flyback')
+    parser.add_argument('--roi', type=int, nargs=2, default=(8, 400), metavar=('TOP', 'BOTTOM'), help='Axial ROI')
+    parser.add_argument('--workers', type=int, nargs='+', help='Worker counts to test. Default is powers of 2 up to '
+                                                               'the CPU count')
+    args = parser.parse_args()
+
+    [pos, X, Y, b1, b2, N, D, idx] = generateIdealFigureEightPositions(0.003, args.alines, padB=args.padding,
+                                                                       flyback=args.flyback)
+    lam = 1 / np.linspace(1 + 0.19 / 2, 1 - 0.19 / 2, 2048)
+    interpTables = generateInterpolationTables(lam)
+    apod = np.hanning(2048)
+    frames = np.random.randint(500, 4000, size=(16, N, 2048)).astype(np.uint16)  # Cycled through
+    roi = tuple(args.roi)
+
+    counts = args.workers or [2 ** i for i in range(int(np.log2(os.cpu_count())) + 1)]
+
+    def process(raw, window):
+        return reconstruct8(raw, idx, window, interpTables, roi, parallel=False)
+
+    # Compile everything before timing
+    reconstruct8(frames[0], idx, apod / updateBackground8(frames[0], idx, 1.0, np.empty([2, 2048])), interpTables, roi)
+    process(frames[0], apod / updateBackground8Serial(frames[0], idx, 1.0, np.empty([2, 2048])))
+
+    print('Figure-8s of ' + str(N) + ' A-lines, ' + str(idx.shape[1]) + ' per B-scan, ROI ' + str(roi))
+    print('workers   frames/s   speedup')
+
+    start = time.perf_counter()
+    for i in range(args.frames):
+        raw = frames[i % len(frames)]
+        reconstruct8(raw, idx, apod / updateBackground8(raw, idx, 1.0, np.empty([2, 2048])), interpTables, roi,
+                     workers=os.cpu_count())
+    reference = args.frames / (time.perf_counter() - start)
+    print('serial'.ljust(10) + str(round(reference, 1)).ljust(11) + '1.00')
+
+    for count in counts:
+        workers = OrderedWorkerPool(count)
+        collected = 0
+        start = time.perf_counter()
+        for i in range(args.frames):
+            if workers.full():
+                workers.next()
+                collected += 1
+            raw = frames[i % len(frames)]
+            workers.submit(process, raw, apod / updateBackground8Serial(raw, idx, 1.0, np.empty([2, 2048])))
+        while collected < args.frames:
+            workers.next()
+            collected += 1
+        rate = args.frames / (time.perf_counter() - start)
+        workers.close()
+        print(str(count).ljust(10) + str(round(rate, 1)).ljust(11) + str(round(rate / reference, 2)))
+
+
+if __name__ == '__main__':
+    main()
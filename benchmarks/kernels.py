@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing of the figure-8 reconstruction with synthetic raw frames, swept over the scan pattern and ROI.
+
+Each case times the stages of FigureEight.process8: the background estimate and window, the fused extraction,
+apodization and resampling kernel, and the depth transform as a full FFT and as the partial DFT of the ROI, followed by
+the whole frame end to end with the transform reconstruct8 picks for the ROI. The equivalent A-line rate is
+the A-lines of a figure-8 over the frame time, which has to exceed the camera's line rate to keep up at that preset.
+Generating the scan pattern is timed too, as it runs on every edit of the scan pattern.
+
+By default each parameter is swept on its own around 100 A-lines per cross, 50 A-line flybacks, ROI of 392 and both
+B-scans. --grid runs every combination instead.
+
+Baselines are stored per machine in benchmarks/baselines. --save writes this machine's, and --check compares a new run
+against it and exits with an error if any frame is slower by more than --tolerance. Only cases present in both are
+compared, so a baseline of the default sweep covers the default run. On a machine without a baseline of its own, such
+as a fresh CI runner, --check compares against the committed benchmarks/baselines/reference.json, which only catches
+regressions on hardware comparable to the machine it was recorded on. --baseline names another file to save or check.
+
+Usage, from the repository root:
+    python -m benchmarks.kernels --save
+    python -m benchmarks.kernels --check
+    python -m benchmarks.kernels --check --baseline benchmarks/baselines/ci.json
+    python -m benchmarks.kernels --alines 5 25 100 400 --flyback 20 --grid
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+
+from src.main.python.PyImage.OCT import generateIdealFigureEightPositions, generateInterpolationTables, \
+    updateBackground8, updateBackground8Serial, preprocess8, preprocess8Serial, fftBScan, dftBScan, reconstruct8, \
+    chooseDepthTransform
+
+RATES = [76000, 146000]  # Hz, camera presets
+NOISE = 0.0002  # s. Slowdowns smaller than this are timing noise of the smallest cases, not regressions
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+REFERENCE = os.path.join(BASELINES, 'reference.json')
+
+
+def timeit(function, repeats):
+    """
+    :return: Median time of a call in seconds
+    """
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def runCase(alines, flyback, depth, bscans, interpTables, parallel, repeats):
+    """
+    :return: Dictionary of stage times in seconds, the number of A-lines in the figure-8 and the depth transform used
+    """
+    padB = min(20, alines - 1)
+    pattern = timeit(lambda: generateIdealFigureEightPositions(0.003, alines, padB=padB, flyback=flyback), repeats)
+    [pos, X, Y, b1, b2, N, D, idx] = generateIdealFigureEightPositions(0.003, alines, padB=padB, flyback=flyback)
+    B = idx if bscans == 2 else idx[0]
+    idx2 = np.atleast_2d(B)
+    roi = (8, 8 + depth)
+    apod = np.hanning(2048)
+    frames = np.random.randint(500, 4000, size=[4, N, 2048]).astype(np.uint16)
+    workers = os.cpu_count() if parallel else 1
+    update = updateBackground8 if parallel else updateBackground8Serial
+    preprocess = preprocess8 if parallel else preprocess8Serial
+
+    bg = np.empty([idx2.shape[0], 2048])
+    window = apod / update(frames[0], idx2, 1.0, bg)
+    spectra = np.empty([idx2.shape[0], idx2.shape[1], 2048])
+    spectra32 = preprocess(frames[2].reshape(-1, 2048), idx2, window, *interpTables, spectra.astype(np.float32))
+
+    def frame(i=[0]):
+        A = frames[i[0] % len(frames)]
+        i[0] += 1
+        w = apod / update(A, idx2, 1.0, np.empty([idx2.shape[0], 2048]))
+        return reconstruct8(A, B, w, interpTables, roi, workers=workers, parallel=parallel)
+
+    frame()  # Compiles or loads the kernels
+    return {
+        'N': int(N),
+        'pattern': pattern,
+        'background': timeit(lambda: apod / update(frames[1], idx2, 1.0, bg), repeats),
+        'preprocess': timeit(lambda: preprocess(frames[2].reshape(-1, 2048), idx2, window, *interpTables, spectra),
+                             repeats),
+        'fft': timeit(lambda: fftBScan(spectra, axis=-1, workers=workers), repeats),
+        'dft': timeit(lambda: dftBScan(spectra32, roi), repeats),
+        'frame': timeit(frame, repeats),
+        'transform': chooseDepthTransform(idx2.size, depth, workers=workers)
+    }
+
+
+def getBaselinePath():
+    name = platform.node() + '_' + platform.machine() + '_' + str(os.cpu_count()) + 'cpu'
+    return os.path.join(BASELINES, name + '.json')
+
+
+def getMachine():
+    # Stored with a baseline so that a comparison against another machine's can be recognized as such
+    return {'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage timing of the figure-8 reconstruction')
+    parser.add_argument('--alines', type=int, nargs='+', default=[5, 25, 100, 200, 400],
+                        help='A-lines per cross, including padding')
+    parser.add_argument('--flyback', type=int, nargs='+', default=[20, 50, 100], help='A-lines per flyback')
+    parser.add_argument('--depth', type=int, nargs='+', default=[392, 1016], help='Depth of the axial ROI in bins')
+    parser.add_argument('--bscans', type=int, nargs='+', choices=[1, 2], default=[1, 2], help='B-scans reconstructed')
+    parser.add_argument('--grid', action='store_true', help='Run every combination of the parameters')
+    parser.add_argument('--serial', action='store_true', help='Single-threaded kernels, as used by the export workers')
+    parser.add_argument('--repeats', type=int, default=30, help='Timed calls per stage. The median is reported')
+    parser.add_argument('--save', action='store_true', help='Store the results as the baseline of this machine')
+    parser.add_argument('--check', action='store_true', help='Fail if any frame is slower than the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Slowdown allowed by --check. Default is 0.25')
+    parser.add_argument('--baseline', help='Baseline file to save or check. Default is this machine\'s, or for --check '
+                                           'the committed reference if this machine has none')
+    args = parser.parse_args()
+
+    lam = 1 / np.linspace(1 + 0.19 / 2, 1 - 0.19 / 2, 2048)
+    interpTables = generateInterpolationTables(lam)
+
+    if args.grid:
+        cases = list(itertools.product(args.alines, args.flyback, args.depth, args.bscans))
+    else:
+        default = (100, 50, 392, 2)
+        cases = [default]
+        for i, values in enumerate([args.alines, args.flyback, args.depth, args.bscans]):
+            for value in values:
+                case = default[:i] + (value,) + default[i + 1:]
+                if case not in cases:
+                    cases.append(case)
+
+    print('Stage times in ms, ' + ('serial' if args.serial else 'parallel') + ' kernels, ' + str(os.cpu_count()) +
+          ' CPUs')
+    print('alines flyback depth b  N     pattern  bg      prep    fft     dft     frame   used kHz      76k  146k')
+    results = {}
+    for alines, flyback, depth, bscans in cases:
+        r = runCase(alines, flyback, depth, bscans, interpTables, not args.serial, args.repeats)
+        key = 'a' + str(alines) + '_f' + str(flyback) + '_z' + str(depth) + '_b' + str(bscans) + \
+              ('_serial' if args.serial else '')
+        results[key] = r
+        rate = r['N'] / r['frame']
+        print(str(alines).ljust(7) + str(flyback).ljust(8) + str(depth).ljust(6) + str(bscans).ljust(3) +
+              str(r['N']).ljust(6) + ''.join(str(round(1000 * r[stage], 2)).ljust(8) for stage in
+                                              ['pattern', 'background', 'preprocess', 'fft', 'dft', 'frame']) +
+              r['transform'].ljust(5) + str(round(rate / 1000, 1)).ljust(9) + ''.join(('ok' if rate >= preset else 'SLOW').ljust(5)
+                                                           for preset in RATES))
+
+    path = args.baseline or getBaselinePath()
+
+    if args.check:
+        if args.baseline is None and not os.path.exists(path):
+            print('No baseline for this machine at ' + path + ', comparing against the reference')
+            path = REFERENCE
+        if not os.path.exists(path):
+            sys.exit('No baseline at ' + path + '. Run with --save first')
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline.get('machine', getMachine()) != getMachine():
+            print('Baseline recorded on ' + str(baseline['machine']) + ', times are only comparable on similar hardware')
+        regressions = []
+        for key, r in results.items():
+            if key in baseline and r['frame'] > baseline[key]['frame'] * (1 + args.tolerance) and \
+                    r['frame'] - baseline[key]['frame'] > NOISE:
+                regressions.append(key + ': ' + str(round(1000 * r['frame'], 2)) + ' ms per frame against ' +
+                                   str(round(1000 * baseline[key]['frame'], 2)) + ' ms')
+        compared = len([key for key in results if key in baseline])
+        if compared == 0:
+            sys.exit('None of the ' + str(len(results)) + ' cases are in the baseline at ' + path +
+                     '. Run with --save to record them')
+        if regressions:
+            sys.exit('REGRESSION, ' + str(len(regressions)) + ' of ' + str(compared) + ' cases more than ' +
+                     str(int(100 * args.tolerance)) + '% slower than the baseline:\n  ' + '\n  '.join(regressions))
+        print('No regressions in ' + str(compared) + ' cases compared against ' + path)
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        baseline['machine'] = getMachine()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print('Saved baseline ' + path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end throughput of the figure-8 GUI on the simulated device, headless. The whole FigureEight controller runs as
+it does with the Telesto: the simulated camera delivers frames at the line rate of the camera preset, and scan mode
+displays them while acquire mode exports them.
+
+Scan mode reports the rate at which B-scans are displayed, the latency from a frame being copied off the camera to it
+being displayed, and frames lost or skipped along the way. Acquire modes report the sustained export rate against the
+camera's frame rate, and frames lost by the camera because the acquisition fell behind. --stages adds the median and
+95th percentile of each stage timed by the controller's PipelineMetrics.
+
+Usage, from the repository root:
+    python -m benchmarks.pipeline --rate 146 --alines 100 --seconds 10 --frames 1000 --modes scan .npy .hdf
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+os.environ['PYIMAGEOCT_DEVICE'] = 'simulated'
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import numpy as np
+from PyQt5.QtWidgets import QApplication, QTabWidget
+
+from src.main.python.PyImage import SpectralRadarControl, SimulatedSpectralRadar
+from src.main.python.PyImage.Buffers import Mailbox
+
+
+def wait(app, condition, timeout):
+    start = time.perf_counter()
+    while not condition() and time.perf_counter() - start < timeout:
+        app.processEvents()
+        time.sleep(0.01)
+    app.processEvents()
+
+
+def instrument(fig8):
+    """
+    Times each displayed B-scan from the copy of its raw frame off the camera. The frames are reconstructed on another
+    thread than the display, so the time of the copy is the one handed to the display with the image
+    :return: List the latencies in seconds are appended to
+    """
+    pending = {}
+    latencies = []
+
+    get = Mailbox.get
+
+    def timedGet(mailbox, timeout=None):
+        item = get(mailbox, timeout)
+        pending[threading.get_ident()] = item[-1]
+        return item
+
+    def timed(update):
+        def timedUpdate(*args):
+            update(*args)
+            start = pending.pop(threading.get_ident(), None)
+            if start is not None:
+                latencies.append(time.perf_counter() - start)
+        return timedUpdate
+
+    Mailbox.get = timedGet
+    fig8.plotBScan.update = timed(fig8.plotBScan.update)
+    fig8.plotBScan.updateScalar = timed(fig8.plotBScan.updateScalar)
+    return latencies
+
+
+def printStages(metrics):
+    for name, stats in metrics.snapshot()['stages'].items():
+        print(' ' * 13 + name.ljust(16) + 'median ' + str(round(stats['p50'], 3)).ljust(8) + 'ms, p95 ' +
+              str(round(stats['p95'], 3)).ljust(8) + 'ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end throughput on the simulated device')
+    parser.add_argument('--rate', type=int, choices=[76, 146], default=76, help='Line rate in kHz')
+    parser.add_argument('--alines', type=int, default=100, help='A-lines per B-scan, including padding')
+    parser.add_argument('--padding', type=int, default=20, help='B-scan padding')
+    parser.add_argument('--flyback', type=int, default=50, help='A-lines per flyback')
+    parser.add_argument('--seconds', type=float, default=10, help='Duration of scan mode')
+    parser.add_argument('--frames', type=int, default=1000, help='Figure-8s per acquisition')
+    parser.add_argument('--processing', choices=['Threads', 'Processes'], default='Threads',
+                        help='Export processing mode')
+    parser.add_argument('--stages', action='store_true', help='Print the time of each pipeline stage')
+    parser.add_argument('--modes', nargs='+', choices=['scan', '.npy', '.hdf', 'Raw spectra'],
+                        default=['scan', '.npy', 'Raw spectra'], help='Modes to run')
+    args = parser.parse_args()
+
+    app = QApplication([])
+    tabs = QTabWidget()
+    fig8 = SpectralRadarControl.FigureEight(parent=tabs)
+    fig8._initThread.join()
+    app.processEvents()
+
+    fig8.groupParams.entryImagingRate.setCurrentIndex([76, 146].index(args.rate))
+    fig8._initThread.join()  # The camera preset is changed in the background
+    fig8.groupParams.entryProcessing.setCurrentIndex(['Threads', 'Processes'].index(args.processing))
+    fig8.groupScanParams.spinALinesPerX.setValue(args.alines)
+    fig8.groupScanParams.spinBPadding.setValue(args.padding)
+    fig8.groupScanParams.spinFlyback.setValue(args.flyback)
+    fig8.groupScanParams.spinFig8Total.setValue(args.frames)
+    fig8.groupScanParams.flush()
+
+    device = fig8._device
+    frameRate = fig8.getRateValue() / fig8.scanPatternN
+    latencies = instrument(fig8)
+
+    print(str(args.rate) + ' kHz, figure-8s of ' + str(fig8.scanPatternN) + ' A-lines, camera at ' +
+          str(round(frameRate, 1)) + ' figure-8s/s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        fig8.groupFile.entryExpDir.setText(directory)
+
+        for mode in args.modes:
+            delivered, lost = SimulatedSpectralRadar.getStatistics(device)
+            t0 = time.perf_counter()
+
+            if mode == 'scan':
+                fig8.initScan()
+                wait(app, lambda: len(latencies) > 0, 30)  # The first frame synthesizes the frame bank
+                pool = fig8._framePool
+                before = pool.getStats()
+                overwritten = fig8.getProcessingQueue().getOverwritten()
+                displayed = len(latencies)
+                start = time.perf_counter()
+                wait(app, lambda: False, args.seconds)
+                elapsed = time.perf_counter() - start
+                displayed = len(latencies) - displayed
+                after = pool.getStats()
+                overwritten = fig8.getProcessingQueue().getOverwritten() - overwritten
+                fig8.abort()
+                wait(app, lambda: False, 1.5)  # Lets the threads see the abort
+
+                delivered2, lost2 = SimulatedSpectralRadar.getStatistics(device)
+                latency = 1000 * np.array(latencies[-displayed:])
+                dropped = after['dropped'] - before['dropped'] + overwritten  # Skipped or reconstructed but not shown
+                total = after['produced'] + after['dropped'] - before['produced'] - before['dropped']
+                print('scan'.ljust(13) + 'displayed ' + str(round(displayed / elapsed, 1)) + ' B-scans/s, latency ' +
+                      'median ' + str(round(np.median(latency), 1)) + ' ms, p95 ' +
+                      str(round(np.percentile(latency, 95), 1)) + ' ms, not displayed ' + str(dropped) + ' of ' +
+                      str(total) + ', camera lost ' + str(lost2 - lost))
+                if args.stages:
+                    printStages(fig8.metrics)
+
+            else:
+                fig8.groupFile.entryExpName.setText('bench_' + mode.strip('.').replace(' ', '_'))
+                fig8.groupFile.entryFileType.setCurrentIndex(['.npy', '.hdf', 'Raw spectra'].index(mode))
+                fig8.groupFile.update()
+                start = time.perf_counter()
+                fig8.initAcq()
+                wait(app, lambda: not fig8.active, 60 + 10 * args.frames / frameRate)
+                elapsed = time.perf_counter() - start
+                pool = fig8._framePool
+                if fig8.active:
+                    fig8.abort()
+                    print(mode.ljust(13) + 'timed out')
+                    continue
+                for thread in list(threading.enumerate()):
+                    if thread is not threading.current_thread() and not thread.daemon:
+                        thread.join()
+
+                delivered2, lost2 = SimulatedSpectralRadar.getStatistics(device)
+                stats = pool.getStats()
+                print(mode.ljust(13) + 'exported ' + str(args.frames) + ' figure-8s at ' +
+                      str(round(args.frames / elapsed, 1)) + ' /s, camera lost ' + str(lost2 - lost) +
+                      ', buffer overruns ' + str(stats['overruns']))
+                if args.stages:
+                    printStages(fig8.metrics)
+
+    fig8.close()
+    tabs.deleteLater()
+    app.processEvents()
+
+
+if __name__ == '__main__':
+    main()
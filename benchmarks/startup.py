@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Startup costs that don't need the device: importing the GUI modules, loading or compiling the reconstruction kernels
+and the latency of the first frame with and without the warm-up that FigureEight runs in the background.
+
+Every stage runs in a fresh interpreter. The kernels are compiled into an empty numba cache directory first, so the
+second run of the warm-up is what a normal start pays. Time to first window and to first B-scan after SCAN are printed
+by the application itself.
+
+Usage, from the repository root:
+    python -m benchmarks.startup
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY = ['numba', 'scipy.fft', 'h5py']
+
+
+def stageImports():
+    start = time.perf_counter()
+    from src.main.python.PyImage import Widgets, Buffers, Cache, Export, ProcessPipeline, OCT
+    elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'loaded': [module for module in HEAVY if module in sys.modules]}
+
+
+def stageWarmUp():
+    from src.main.python.PyImage.OCT import warmUp
+    return {'seconds': warmUp()}
+
+
+def stageFirstFrame(warm):
+    import numpy as np
+    from src.main.python.PyImage.OCT import generateIdealFigureEightPositions, generateInterpolationTables, \
+        updateBackground8, reconstruct8, warmUp
+
+    if warm:
+        warmUp()
+    [pos, X, Y, b1, b2, N, D, idx] = generateIdealFigureEightPositions(0.003, 100, padB=20, flyback=50)
+    interpTables = generateInterpolationTables(1 / np.linspace(1 + 0.19 / 2, 1 - 0.19 / 2, 2048))
+    A = np.random.randint(500, 4000, size=[N, 2048]).astype(np.uint16)
+
+    start = time.perf_counter()
+    window = np.hanning(2048) / updateBackground8(A, idx, 1.0, np.empty([2, 2048]))
+    reconstruct8(A, idx, window, interpTables, (8, 400))
+    return {'seconds': time.perf_counter() - start}
+
+
+def runStage(stage, cacheDir):
+    env = dict(os.environ, NUMBA_CACHE_DIR=cacheDir)
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--stage', stage], env=env, check=True,
+                            stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup costs of the GUI modules and processing kernels')
+    parser.add_argument('--stage', choices=['imports', 'warmup', 'cold', 'warm'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage is not None:
+        stages = {
+            'imports': stageImports,
+            'warmup': stageWarmUp,
+            'cold': lambda: stageFirstFrame(False),
+            'warm': lambda: stageFirstFrame(True)
+        }
+        print(json.dumps(stages[args.stage]()))
+        return
+
+    with tempfile.TemporaryDirectory() as cacheDir:
+        imports = runStage('imports', cacheDir)
+        compiled = runStage('warmup', cacheDir)
+        cached = runStage('warmup', cacheDir)
+        cold = runStage('cold', cacheDir)
+        warm = runStage('warm', cacheDir)
+
+    print('GUI module imports'.ljust(36) + str(round(imports['seconds'], 3)).ljust(8) + 's, ' +
+          'loaded ' + (', '.join(imports['loaded']) or 'none of ' + ', '.join(HEAVY)))
+    print('Kernel warm-up, empty cache'.ljust(36) + str(round(compiled['seconds'], 3)).ljust(8) + 's')
+    print('Kernel warm-up, cached'.ljust(36) + str(round(cached['seconds'], 3)).ljust(8) + 's')
+    print('First frame without warm-up'.ljust(36) + str(round(1000 * cold['seconds'], 1)).ljust(8) + 'ms')
+    print('First frame after warm-up'.ljust(36) + str(round(1000 * warm['seconds'], 1)).ljust(8) + 'ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Offline reconstruction of recorded raw figure-8 spectra, without the GUI or the device.
+
+Raw files are read as consecutive A-lines of 2048 samples, so both the [repeats, ...] files written by the raw
+spectra acquisition mode and single recordings of a repeated pattern, like those saved by cmd_line_multi_acq.py, can
+be processed. The figure-8 geometry and chirp come either from the _params.npz file saved next to a raw acquisition,
+or from the command line. Patterns other than generateIdealFigureEightPositions', such as cmd_line_multi_acq.py's,
+which has flybacks of 16, 32 and 17 A-lines, are described by an index map of the A-lines in each B-scan and the
+number of A-lines in the pattern. Frames are split across a pool of processes, each of which writes its B-scans
+straight into its own frames of the output .npy, so the output is in acquisition order.
+
+Usage:
+    python cmd_line_reprocess.py fig8_0_raw.npy --params fig8_0_params.npz
+    python cmd_line_reprocess.py fig8_raw.npy --chirp lam.npy --alines 40 --padding 0 --flyback 20 -j 8
+    python cmd_line_reprocess.py fig8_raw.npy --chirp lam.npy --idx idx.npy --N 145
+
+where idx.npy of a cmd_line_multi_acq.py recording with 40 A-lines per cross is
+    np.save('idx.npy', np.array([16 + np.arange(40), 16 + 40 + 32 + np.arange(40)]))
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from src.main.python.PyImage.OCT import generateIdealFigureEightPositions, generateInterpolationTables, \
+    updateBackground8, reconstruct8
+
+WINDOWS = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'none': np.ones
+}
+
+_worker = {}
+
+
+def initWorker(rawPath, outPath, idx, apod, interpTables, roi):
+    import src.main.python.PyImage.Kernels  # Sets numba's cache directory and threading layer before it launches
+    import numba
+    numba.set_num_threads(1)  # Parallelism comes from the process pool
+    _worker['raw'] = np.load(rawPath, mmap_mode='r').reshape(-1, 2048)
+    _worker['out'] = np.load(outPath, mmap_mode='r+')
+    _worker['idx'] = idx
+    _worker['apod'] = apod
+    _worker['interpTables'] = interpTables
+    _worker['roi'] = roi
+
+
+def processFrames(frames):
+    """
+    Reconstructs frames [start, stop) into the output file, with the same math as FigureEight.process8 in its
+    per-frame background mode
+    """
+    raw = _worker['raw']
+    out = _worker['out']
+    idx = _worker['idx']
+    start, stop, N = frames
+    for i in range(start, stop):
+        A = raw[i * N:(i + 1) * N]
+        window = _worker['apod'] / updateBackground8(A, idx, 1.0, np.empty([idx.shape[0], 2048]))
+        out[..., i] = reconstruct8(A, idx, window, _worker['interpTables'], _worker['roi'])
+    out.flush()
+    return stop - start
+
+
+def loadParams(args):
+    """
+    :return: lam, apod, idx, N, roi
+    """
+    if args.params is not None:
+        params = np.load(args.params)
+        lam = params['lam']
+        apod = params['apod']
+        idx = params['scanPatternIdx']
+        N = int(params['scanPatternN'])
+        roi = tuple(int(z) for z in params['roi'])
+    else:
+        if args.chirp is None:
+            raise ValueError('Either --params or --chirp and the scan pattern parameters are required')
+        lam = np.load(args.chirp)
+        apod = None
+        if args.idx is not None:
+            if args.N is None:
+                raise ValueError('--idx requires --N, the number of A-lines in the pattern')
+            idx = np.atleast_2d(np.load(args.idx)).astype(np.int64)
+            N = args.N
+            if idx.min() < 0 or idx.max() >= N:
+                raise ValueError('--idx indexes A-lines outside a pattern of ' + str(N))
+        else:
+            [pos, X, Y, b1, b2, N, D, idx] = generateIdealFigureEightPositions(args.spacing * 10 ** -3,  # um to mm
+                                                                               args.alines,
+                                                                               padB=args.padding,
+                                                                               rpt=1,
+                                                                               angle=args.angle * (np.pi / 180),
+                                                                               flyback=args.flyback,
+                                                                               flybackAngle=args.flyback_angle * (np.pi / 180))
+        roi = (8, 400)
+    if args.window is not None or apod is None:
+        apod = WINDOWS[args.window or 'hann'](2048)
+    if args.roi is not None:
+        roi = tuple(args.roi)
+    return lam, apod, idx, N, roi
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconstruct recorded raw figure-8 spectra into complex B-scans')
+    parser.add_argument('raw', help='Raw uint16 .npy file')
+    parser.add_argument('-o', '--output', help='Output .npy file. Default is the raw file name with _processed')
+    parser.add_argument('--params', help='_params.npz file saved with a raw acquisition')
+    parser.add_argument('--chirp', help='Chirp, i.e. lam.npy. Required without --params')
+    parser.add_argument('--alines', type=int, default=100, help='A-lines per B-scan, including padding')
+    parser.add_argument('--padding', type=int, default=20, help='B-scan padding')
+    parser.add_argument('--flyback', type=int, default=50, help='A-lines per flyback')
+    parser.add_argument('--spacing', type=float, default=3.0, help='Distance between A-lines in the B-scans in um')
+    parser.add_argument('--angle', type=float, default=43, help='Scan pattern angle in degrees')
+    parser.add_argument('--flyback-angle', type=float, default=74.5, help='Flyback angle in degrees')
+    parser.add_argument('--idx', help='Index map of the A-lines in each B-scan, [b, n] .npy, in place of the scan '
+                                      'pattern parameters. Requires --N')
+    parser.add_argument('--N', type=int, help='Number of A-lines in the pattern, with --idx')
+    parser.add_argument('--window', choices=sorted(WINDOWS), help='Apodization window. Default is hann or the one saved '
+                                                                  'in --params')
+    parser.add_argument('--roi', type=int, nargs=2, metavar=('TOP', 'BOTTOM'), help='Axial ROI. Default is 8 400 or '
+                                                                                  'the one saved in --params')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='Number of processes')
+    parser.add_argument('--chunk', type=int, default=16, help='Frames per task')
+    args = parser.parse_args()
+
+    lam, apod, idx, N, roi = loadParams(args)
+    interpTables = generateInterpolationTables(lam)
+
+    raw = np.load(args.raw, mmap_mode='r')
+    if raw.size % (2048 * N) != 0:
+        raise ValueError(args.raw + ' holds ' + str(raw.size // 2048) + ' A-lines, which is not a whole number of '
+                         'figure-8s of ' + str(N) + '. Check the scan pattern parameters')
+    repeats = raw.size // (2048 * N)
+    del raw
+
+    output = args.output or os.path.splitext(args.raw)[0] + '_processed.npy'
+    shape = (roi[1] - roi[0], idx.shape[1], idx.shape[0], repeats)  # Same layout as the .npy export
+    out = np.lib.format.open_memmap(output, mode='w+', dtype=np.complex64, shape=shape, fortran_order=True)
+    del out
+
+    print('Reconstructing ' + str(repeats) + ' figure-8s of ' + str(N) + ' A-lines with ' + str(args.jobs) +
+          ' processes...')
+    tasks = [(start, min(start + args.chunk, repeats), N) for start in range(0, repeats, args.chunk)]
+    start = time.time()
+    done = 0
+    with Pool(args.jobs, initializer=initWorker, initargs=(args.raw, output, idx, apod, interpTables, roi)) as pool:
+        for n in pool.imap_unordered(processFrames, tasks):
+            done += n
+            print('\r' + str(done) + '/' + str(repeats), end='')
+    elapsed = time.time() - start
+    print('\nDone in ' + str(elapsed)[0:6] + ' s, ' + str(repeats / elapsed)[0:6] + ' figure-8s per second. Saved ' +
+          output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+
+import numpy as np
+
+
+class FramePool:
+    """
+    Fixed number of preallocated frame slots which raw data is copied into directly. Producers borrow a free slot,
+    fill it and pass its index on; consumers return the slot with release once they are done with the frame. When no
+    slot is free the producer either waits or drops the frame, and both are counted
+    """
+
+    def __init__(self, slots, shape=None, dtype=np.uint16):
+        """
+        :param slots: Number of frame slots
+        :param shape: Shape of a frame. If None, the slots are allocated by the first call to allocate
+        :param dtype: Data type of a frame. Default is uint16
+        """
+        self._slots = slots
+        self._dtype = dtype
+        self._frames = None
+        self._free = Queue()
+        self._produced = 0
+        self._dropped = 0
+        self._overruns = 0
+        if shape is not None:
+            self.allocate(shape)
+
+    def allocate(self, shape):
+        """
+        Allocates the slots for frames of the given shape. Does nothing if they already have that shape. Must not be
+        called while slots are borrowed
+        """
+        shape = tuple(shape)
+        if self._frames is not None and self._frames.shape[1:] == shape:
+            return
+        self._frames = np.empty((self._slots,) + shape, dtype=self._dtype)
+        self._free = Queue()
+        for slot in range(self._slots):
+            self._free.put(slot)
+
+    def borrow(self, block=True, timeout=None):
+        """
+        :param block: If True, wait for a slot to be released when none is free. Otherwise the frame is dropped
+        :param timeout: Maximum time to wait in seconds. Default is no limit
+        :return: Index of a free slot, or None if the frame has to be dropped
+        """
+        try:
+            slot = self._free.get_nowait()
+        except Empty:
+            self._overruns += 1
+            if not block:
+                self._dropped += 1
+                return None
+            try:
+                slot = self._free.get(timeout=timeout)
+            except Empty:
+                self._dropped += 1
+                return None
+        self._produced += 1
+        return slot
+
+    def release(self, slot):
+        self._free.put(slot)
+
+    def drop(self, slot):
+        # A borrowed slot whose frame is discarded before being consumed
+        self._dropped += 1
+        self._produced -= 1
+        self.release(slot)
+
+    def frame(self, slot):
+        return self._frames[slot]
+
+    def getFree(self):
+        return self._free.qsize()
+
+    def getStats(self):
+        """
+        :return: produced: Number of frames handed to consumers
+                 dropped: Number of frames dropped because no slot was free or the consumer was busy
+                 overruns: Number of times no slot was free when a frame arrived
+        """
+        return {'produced': self._produced, 'dropped': self._dropped, 'overruns': self._overruns}
+
+
+class OrderedWorkerPool:
+    """
+    Runs tasks on a pool of threads and hands back their results in the order they were submitted, holding results
+    that finish early until those before them are done. Threads only help where the work releases the GIL, as
+    numba nogil kernels and scipy.fft do
+    """
+
+    def __init__(self, workers, maxPending=None):
+        """
+        :param workers: Number of threads
+        :param maxPending: Maximum number of tasks submitted but not yet collected. Default is twice the workers
+        """
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = deque()
+        self._maxPending = maxPending or 2 * workers
+
+    def submit(self, fn, *args):
+        self._pending.append(self._executor.submit(fn, *args))
+
+    def full(self):
+        return len(self._pending) >= self._maxPending
+
+    def next(self):
+        """
+        :return: Result of the oldest pending task, waiting for it if necessary
+        """
+        return self._pending.popleft().result()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class Mailbox:
+    """
+    Holds only the latest item. put never blocks: an item that has not been taken yet is replaced and returned so that
+    the producer can recycle it, and is counted as overwritten. Used in place of a Queue(maxsize=1) so that a slow
+    consumer cannot stall the producer
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item = None
+        self._full = False
+        self._overwritten = 0
+
+    def put(self, item):
+        """
+        :return: The stale item that was replaced, or None
+        """
+        with self._condition:
+            stale = self._item if self._full else None
+            if self._full:
+                self._overwritten += 1
+            self._item = item
+            self._full = True
+            self._condition.notify()
+        return stale
+
+    def get(self, timeout=None):
+        """
+        :param timeout: Maximum time to wait for an item in seconds. Default is no limit
+        :return: The latest item
+        :raises Empty: If no item arrived within the timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._full, timeout=timeout):
+                raise Empty
+            item = self._item
+            self._item = None
+            self._full = False
+        return item
+
+    def getOverwritten(self):
+        return self._overwritten
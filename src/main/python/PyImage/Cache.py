@@ -0,0 +1,169 @@
+import hashlib
+import os
+import re
+import threading
+import zipfile
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    Fixed capacity map which evicts the least recently used entry. An eviction callback can release resources held by
+    evicted values, such as SDK handles
+    """
+
+    def __init__(self, capacity, onEvict=None):
+        """
+        :param capacity: Maximum number of entries
+        :param onEvict: Called with each evicted value. Default is None
+        """
+        self._capacity = capacity
+        self._onEvict = onEvict
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        """
+        :param key: Hashable key
+        :return: The cached value, which becomes the most recently used, or None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Adds or replaces an entry, evicting the least recently used entries over capacity
+        :param key: Hashable key
+        :param value: Value to cache
+        """
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                old = self._entries.pop(key)
+                if old is not value:
+                    evicted.append(old)
+            self._entries[key] = value
+            while len(self._entries) > self._capacity:
+                evicted.append(self._entries.popitem(last=False)[1])
+        for old in evicted:
+            self._evict(old)
+
+    def clear(self):
+        """
+        Evicts every entry
+        """
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+        for old in evicted:
+            self._evict(old)
+
+    def _evict(self, value):
+        if self._onEvict is not None:
+            self._onEvict(value)
+
+    def getStats(self):
+        """
+        :return: hits, misses
+        """
+        return self._hits, self._misses
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def getCacheDirectory():
+    """
+    :return: Per-user cache directory of the application, %LOCALAPPDATA%/PyImageOCT on Windows and
+             $XDG_CACHE_HOME/PyImageOCT or ~/.cache/PyImageOCT elsewhere. Created if it doesn't exist
+    """
+    root = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME') or str(Path.home() / '.cache')
+    directory = Path(root) / 'PyImageOCT'
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+class CalibrationStore:
+    """
+    Chirps and the resampling tables built from them, saved per device, probe configuration and camera preset so that
+    they don't have to be queried from the SDK and rebuilt every time the device is initialized
+    """
+
+    VERSION = 1
+
+    def __init__(self, directory=None, n=2048):
+        """
+        :param directory: Directory of the calibration files. Default is the calibration folder of the cache directory
+        :param n: Number of camera pixels. Default is 2048
+        """
+        if directory is None:
+            directory = getCacheDirectory() / 'calibration'
+        self._directory = Path(directory)
+        self._n = n
+
+    def getPath(self, device, probe, preset):
+        """
+        :param device: Device identity, i.e. its serial number
+        :param probe: Probe configuration name
+        :param preset: Camera preset
+        :return: Path of the calibration file
+        """
+        name = '_'.join(re.sub(r'[^A-Za-z0-9.-]', '-', str(key)) for key in (device, probe, preset))
+        return self._directory / (name + '.npz')
+
+    def load(self, device, probe, preset, reference=None):
+        """
+        :param reference: pixels, wavelengths read from the device at those pixels. Default is None, the chirp is not
+                          checked against the device
+        :return: lam, interpTables, or None if there is no valid entry, or its chirp doesn't match the reference
+        """
+        try:
+            with np.load(self.getPath(device, probe, preset)) as entry:
+                lam = entry['lam']
+                interpTables = [entry['i0'], entry['i1'], entry['w']]
+                valid = int(entry['version']) == self.VERSION and str(entry['lamHash']) == self._hash(lam)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        if not valid or not self._isValid(lam, interpTables):
+            return None
+        if reference is not None and not np.allclose(lam[reference[0]], reference[1], rtol=1e-9, atol=0):
+            return None
+        return lam, interpTables
+
+    def save(self, device, probe, preset, lam, interpTables):
+        """
+        Writes an entry, replacing any previous one
+        :param lam: Chirp
+        :param interpTables: Resampling tables from generateInterpolationTables(lam)
+        """
+        self._directory.mkdir(parents=True, exist_ok=True)
+        path = self.getPath(device, probe, preset)
+        temp = path.with_suffix('.tmp.npz')
+        np.savez(temp, version=self.VERSION, lam=lam, lamHash=self._hash(lam), i0=interpTables[0],
+                 i1=interpTables[1], w=interpTables[2])
+        os.replace(temp, path)  # Readers never see a partly written file
+
+    def _hash(self, lam):
+        return hashlib.sha1(np.ascontiguousarray(lam, dtype=np.float64).tobytes()).hexdigest()
+
+    def _isValid(self, lam, interpTables):
+        i0, i1, w = interpTables
+        if lam.shape != (self._n,) or not np.all(np.isfinite(lam)) or np.unique(lam).size < 2:
+            return False
+        for i in (i0, i1):
+            if i.shape != (self._n,) or i.min() < 0 or i.max() >= self._n:
+                return False
+        return w.shape == (self._n,) and bool(np.all((w >= 0) & (w <= 1)))
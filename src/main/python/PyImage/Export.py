@@ -0,0 +1,217 @@
+import os
+import threading
+from queue import Queue
+
+import numpy as np
+
+
+class HDFWriter:
+    """
+    Streams processed figure-8s into a chunked, resizable HDF5 dataset as they arrive so that memory use does not
+    depend on the number of repeats. Frames are stacked along the last axis, i.e. [z, n, b, repeats], the same layout
+    as the .npy export
+    """
+
+    def __init__(self, path, frameShape, dtype=np.complex64, chunks=None, compression='lzf', compressionOpts=None,
+                 attrs=None, name='fig8'):
+        """
+        :param path: Path of the .hdf file to create. An existing file is overwritten
+        :param frameShape: Shape of a single processed figure-8
+        :param dtype: Data type of the dataset. Default is complex64
+        :param chunks: Chunk shape of the dataset, including the repeat axis. Default is one frame per chunk
+        :param compression: h5py compression filter, i.e. 'lzf', 'gzip' or None. Default is 'lzf'
+        :param compressionOpts: Options for the compression filter, i.e. the gzip level
+        :param attrs: Dictionary of attributes stored with the dataset
+        :param name: Name of the dataset. Default is 'fig8'
+        """
+        import h5py  # Only loaded when an .hdf export starts
+        frameShape = tuple(frameShape)
+        if chunks is None:
+            chunks = frameShape + (1,)
+        self._file = h5py.File(path, 'w')
+        self._dataset = self._file.create_dataset(name,
+                                                  shape=frameShape + (0,),
+                                                  maxshape=frameShape + (None,),
+                                                  dtype=dtype,
+                                                  chunks=tuple(chunks),
+                                                  compression=compression,
+                                                  compression_opts=compressionOpts)
+        if attrs is not None:
+            for key, value in attrs.items():
+                self._dataset.attrs[key] = value
+        self._step = chunks[-1]  # The dataset grows one chunk of repeats at a time
+        self._count = 0
+
+    def append(self, frame):
+        if self._count == self._dataset.shape[-1]:
+            self._dataset.resize(self._count + self._step, axis=self._dataset.ndim - 1)
+        self._dataset[..., self._count] = frame
+        self._count += 1
+
+    def getCount(self):
+        return self._count
+
+    def close(self):
+        self._dataset.resize(self._count, axis=self._dataset.ndim - 1)  # Trim unused repeats of the last chunk
+        self._file.close()
+
+
+class NpyWriter:
+    """
+    Writes processed figure-8s straight into a .npy file on disk as they are produced. The array is stored in Fortran
+    order so that each repeat of [z, n, b, repeats] is contiguous in the file, and frames are appended with sequential
+    writes to a file kept open, which keeps resident memory to a single frame. The file is only synced to disk by
+    close. If fewer frames than planned are written, close rewrites the header and truncates the file so that it
+    remains a valid .npy of the frames that were acquired
+    """
+
+    def __init__(self, path, frameShape, repeats, dtype=np.complex64):
+        """
+        :param path: Path of the .npy file to create. An existing file is overwritten
+        :param frameShape: Shape of a single processed figure-8
+        :param repeats: Number of frames planned
+        :param dtype: Data type of the array. Default is complex64
+        """
+        self._path = path
+        self._frameShape = tuple(frameShape)
+        self._dtype = np.dtype(dtype)
+        self._repeats = repeats
+        self._count = 0
+        # Creates the header and a sparse file of the full size
+        created = np.lib.format.open_memmap(path, mode='w+', dtype=self._dtype, shape=self._frameShape + (repeats,),
+                                            fortran_order=True)
+        offset = created.offset
+        del created
+        self._file = open(path, 'r+b')
+        self._file.seek(offset)
+
+    def append(self, frame):
+        frame = np.asarray(frame, dtype=self._dtype)
+        if frame.shape != self._frameShape:
+            raise ValueError('Frame of shape ' + str(frame.shape) + ', expected ' + str(self._frameShape))
+        self._file.write(np.ascontiguousarray(frame.T).data)  # The transpose is C ordered with the bytes of F order
+        self._count += 1
+
+    def getCount(self):
+        return self._count
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self._count < self._repeats:
+            truncateNpy(self._path, self._count)
+
+
+def truncateNpy(path, n):
+    """
+    Truncates a .npy file in place to the first n elements of its slowest axis, i.e. the last axis of a Fortran ordered
+    array or the first axis of a C ordered one, by rewriting the shape in the header and cutting off the rest of the
+    data. The header keeps its original length so the data does not move
+    :param path: Path of the .npy file
+    :param n: Number of elements of the slowest axis to keep
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+        prefix = 10 if version == (1, 0) else 12  # Magic string, version and header length field
+        if fortranOrder:
+            shape = tuple(shape[:-1]) + (n,)
+        else:
+            shape = (n,) + tuple(shape[1:])
+        header = "{'descr': %r, 'fortran_order': %r, 'shape': %r, }" % (np.lib.format.dtype_to_descr(dtype),
+                                                                          fortranOrder, shape)
+        f.seek(prefix)
+        f.write(header.ljust(offset - prefix - 1).encode('latin1') + b'\n')
+        f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+
+class RawWriter:
+    """
+    Write-behind writer for raw spectra. Frames are handed to a background thread which appends them to a .npy file of
+    shape [repeats, ...] through a large write buffer, so the disk sees big sequential writes and the acquisition
+    thread only waits when the disk falls behind by more than maxFrames. If a write fails, the frames still queued are
+    discarded and the exception is raised by the next append and by close
+    """
+
+    def __init__(self, path, frameShape, repeats, dtype=np.uint16, maxFrames=64, bufferSize=64 * 2 ** 20):
+        """
+        :param path: Path of the .npy file to create. An existing file is overwritten
+        :param frameShape: Shape of a single raw frame
+        :param repeats: Number of frames planned
+        :param dtype: Data type of the frames. Default is uint16
+        :param maxFrames: Maximum number of frames waiting to be written. Default is 64
+        :param bufferSize: Size of the write buffer in bytes. Default is 64 MB
+        """
+        self._path = path
+        self._repeats = repeats
+        self._count = 0
+        self._error = None
+        created = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(repeats,) + tuple(frameShape))
+        offset = created.offset
+        del created
+        self._file = open(path, 'r+b', buffering=bufferSize)
+        self._file.seek(offset)
+        self._queue = Queue(maxsize=maxFrames)
+        self._thread = threading.Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                continue  # Drains the queue so that append never blocks
+            frame, done = item
+            try:
+                self._file.write(np.ascontiguousarray(frame).data)
+            except Exception as e:
+                self._error = e
+                continue
+            self._count += 1
+            if done is not None:
+                done()
+
+    def append(self, frame, done=None):
+        """
+        Queues a frame for writing. The frame must not be modified until it has been written
+        :param frame: Raw frame
+        :param done: Optional function called once the frame has been handed to the write buffer. Not called for the
+                     frames discarded after a failed write
+        :raises: The exception of a failed write
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put((frame, done))
+
+    def getCount(self):
+        return self._count
+
+    def getBacklog(self):
+        return self._queue.qsize()
+
+    def getError(self):
+        return self._error
+
+    def close(self):
+        """
+        Writes the frames still queued and closes the file, truncated to the frames written
+        :raises: The exception of a failed write
+        """
+        self._queue.put(None)
+        self._thread.join()
+        try:
+            self._file.close()  # Flushes the write buffer
+        except Exception as e:
+            if self._error is None:
+                self._error = e
+        if self._count < self._repeats:
+            truncateNpy(self._path, self._count)
+        if self._error is not None:
+            raise self._error
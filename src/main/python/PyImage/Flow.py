@@ -0,0 +1,106 @@
+import numpy as np
+
+from src.main.python.PyImage.OCT import updateFlow8, updateFlow8Serial
+
+
+class FlowContrast:
+    """
+    Flow contrast of repeated figure-8s, streamed frame by frame. Keeps a sliding window of the last frames' intensity
+    and bulk-corrected phase difference at each pixel, whose variances are updated incrementally as each frame replaces
+    the oldest. Memory is the window of samples and the running statistics, however many frames are streamed. Static
+    tissue keeps its speckle and phase from frame to frame while flow decorrelates both, so flow has a high normalized
+    intensity variance and phase variance
+    """
+
+    def __init__(self, window=8):
+        """
+        :param window: Number of frames in the window. Default is 8
+        """
+        self._window = window
+        self._shape = None
+        self.reset()
+
+    def reset(self, window=None):
+        """
+        Empties the window
+        :param window: New number of frames in the window. Default is to keep it
+        """
+        if window is not None:
+            self._window = window
+        self._shape = None
+        self._previous = None
+        self._intensity = None
+        self._phase = None
+        self._stats = None
+        self._count = 0
+        self._slot = 0
+        self._frame = None
+
+    def _allocate(self, shape):
+        z, n, b = shape
+        self._shape = shape
+        self._previous = np.empty([b, n, z], dtype=np.complex64)
+        self._intensity = np.empty([self._window, b, n, z], dtype=np.float32)
+        self._phase = np.empty([self._window, b, n, z], dtype=np.float32)
+        self._stats = np.zeros([4, b, n, z])
+        self._count = 0
+        self._slot = 0
+
+    def update(self, bscans, parallel=True, frame=None):
+        """
+        Adds a frame. The first frame after a reset, after the shape of the B-scans changes or after frames were
+        dropped only sets the reference for the phase differences of the next, and the window starts over
+        :param bscans: Complex B-scans, [z, n, b], or [z, n] for a single B-scan
+        :param parallel: If False, the single-threaded kernel is used. Default is True
+        :param frame: Number of the frame since the start, counting those dropped. Default is to take every frame as
+                      following the previous one
+        :return: True if the window is full
+        """
+        if bscans.ndim == 2:
+            bscans = bscans[:, :, None]
+        gap = frame is not None and self._frame is not None and frame != self._frame + 1
+        self._frame = frame
+        if bscans.shape != self._shape or gap:
+            self._allocate(bscans.shape)
+            self._previous[:] = bscans.transpose(2, 1, 0)
+            return False
+        update = updateFlow8 if parallel else updateFlow8Serial
+        update(bscans, self._previous, self._intensity, self._phase, self._slot, self._count, self._stats)
+        self._count = min(self._count + 1, self._window)
+        self._slot = (self._slot + 1) % self._window
+        return self.isReady()
+
+    def isReady(self):
+        return self._count == self._window
+
+    def getWindow(self):
+        return self._window
+
+    def getIntensityVariance(self):
+        """
+        :return: Sample variance of the intensity |z|^2 over the window, [z, n, b] or None before two frames are added
+        """
+        if self._count < 2:
+            return None
+        return np.maximum(self._stats[1], 0).transpose(2, 1, 0) / (self._count - 1)
+
+    def getSpeckleVariance(self):
+        """
+        :return: Intensity variance normalized by the squared mean intensity, [z, n, b] or None before two frames are
+                 added. Around 1 where the speckle decorrelates fully and 0 where it is static
+        """
+        variance = self.getIntensityVariance()
+        if variance is None:
+            return None
+        mean = self._stats[0].transpose(2, 1, 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(variance / (mean * mean))
+
+    def getPhaseVariance(self):
+        """
+        :return: Sample variance of the bulk-corrected phase difference between frames in rad^2 over the window,
+                 [z, n, b] or None before two frames are added. Around pi^2 / 3 where the phase is random
+        """
+        if self._count < 2:
+            return None
+        return np.maximum(self._stats[3], 0).transpose(2, 1, 0) / (self._count - 1)
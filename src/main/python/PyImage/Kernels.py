@@ -0,0 +1,172 @@
+"""
+Numba kernels of the figure-8 reconstruction. Only imported by OCT once a frame is processed, so that numba isn't loaded
+before the GUI is up. Compiled kernels are cached on disk in the per-user cache directory, or NUMBA_CACHE_DIR if set
+"""
+
+import os
+import sys
+import types
+
+from src.main.python.PyImage.Cache import getCacheDirectory
+
+os.environ.setdefault('NUMBA_CACHE_DIR', str(getCacheDirectory() / 'numba'))
+# Parallel kernels are launched from the warm-up and scan processing threads, one at a time. Python hangs on exit once
+# TBB has been started from a thread other than the main one, so it's only used if neither of the others is available
+os.environ.setdefault('NUMBA_THREADING_LAYER_PRIORITY', 'omp workqueue tbb')
+
+import numba
+import numpy as np
+
+# numba reads its environment when it is first imported, which may have been before this module. The threading layer
+# can't be changed once it has been launched, by a parallel kernel or set_num_threads
+numba.config.reload_config()
+
+CACHE = not getattr(sys, 'frozen', False)  # Frozen builds have no source files for numba to validate its cache with
+
+
+@numba.njit(parallel=True, nogil=True, cache=CACHE)
+def updateBackground8(A, B, alpha, bg):
+    """
+    Compiled w numba in nopython mode. Folds the mean spectrum of the B-scans of a raw figure-8 into a background
+    estimate in place, bg = (1 - alpha) * bg + alpha * mean. alpha = 1 replaces the estimate with this frame's mean, in
+    which case bg does not need to be initialized
+    :param A: Raw uint16 OCT spectral data viewed as [N, 2048] A-scans
+    :param B: Index map of the A-scans in each B-scan, [b, n]
+    :param alpha: Weight of this frame's mean spectrum
+    :param bg: Background estimate, [b, 2048] with one spectrum per B-scan or [1, 2048] pooled over all B-scans
+    :return: bg
+    """
+    nb, nx = B.shape
+    nz = A.shape[1]
+    nw = bg.shape[0]
+    scale = alpha * nw / (nx * nb)
+    # Blocks of pixels so that each thread reads its A-line segments contiguously
+    for c in numba.prange((nz + 63) // 64):
+        z0 = c * 64
+        z1 = min(z0 + 64, nz)
+        for r in range(nw):
+            for z in range(z0, z1):
+                bg[r, z] = 0.0 if alpha == 1.0 else bg[r, z] * (1 - alpha)
+        for b in range(nb):
+            r = min(b, nw - 1)
+            for n in range(nx):
+                row = B[b, n]
+                for z in range(z0, z1):
+                    bg[r, z] += scale * A[row, z]
+    return bg
+
+
+@numba.njit(parallel=True, nogil=True, cache=CACHE)
+def preprocess8(A, B, window, i0, i1, w, out):
+    """
+    Compiled w numba in nopython mode. Extracts the B-scans from raw figure-8 OCT data, normalizes and apodizes them
+    with a single multiply and resamples them in one parallel pass
+    :param A: Raw uint16 OCT spectral data viewed as [N, 2048] A-scans
+    :param B: Index map of the A-scans in each B-scan, [b, n]
+    :param window: Apodization window divided by the background spectrum, [b, 2048] or [1, 2048] shared by all B-scans
+    :param i0: Lower neighbor indices from generateInterpolationTables
+    :param i1: Upper neighbor indices from generateInterpolationTables
+    :param w: Weights of the upper neighbors from generateInterpolationTables
+    :param out: Output array, [b, n, z] where b is B-scan, n is lateral A-scans and z is the resampled spectrum
+    :return: out
+    """
+    nb, nx = B.shape
+    nw = window.shape[0]
+    for j in numba.prange(nb * nx):
+        b = j // nx
+        r = min(b, nw - 1)
+        row = B[b, j % nx]
+        for k in range(out.shape[2]):
+            out[b, j % nx, k] = A[row, i0[k]] * window[r, i0[k]] * (1 - w[k]) + A[row, i1[k]] * window[r, i1[k]] * w[k]
+    return out
+
+
+@numba.njit(parallel=True, nogil=True, cache=CACHE)
+def updateFlow8(X, previous, intensity, phase, slot, count, stats):
+    """
+    Compiled w numba in nopython mode. Adds a frame of complex B-scans to sliding windows of the intensity and of the
+    phase difference from the previous frame at each pixel, replacing the oldest sample once a window is full. The mean
+    and sum of squared deviations of each window are updated in place with Welford's method, so the cost doesn't depend
+    on the window length. Phase differences are corrected for the bulk phase of each A-line
+    :param X: Complex B-scans, [z, n, b]
+    :param previous: Complex B-scans of the previous frame, [b, n, z]. Replaced with X
+    :param intensity: Ring of the intensities in the window, [window, b, n, z]
+    :param phase: Ring of the phase differences in the window, [window, b, n, z]
+    :param slot: Slot of the rings this frame's samples go in, holding the oldest sample if the window is full
+    :param count: Number of samples in the window before this frame
+    :param stats: Mean and sum of squared deviations of the intensity and of the phase difference, [4, b, n, z]
+    :return: stats
+    """
+    nz, nx, nb = X.shape
+    full = count == intensity.shape[0]
+    k = count if full else count + 1
+    for j in numba.prange(nb * nx):
+        b = j // nx
+        n = j % nx
+        bulk = 0j
+        for z in range(nz):
+            bulk += X[z, n, b] * np.conj(previous[b, n, z])
+        bulk = np.conj(bulk) / abs(bulk) if abs(bulk) > 0 else 1.0 + 0j
+        for z in range(nz):
+            x = X[z, n, b]
+            slide(intensity, stats, 0, slot, b, n, z, x.real * x.real + x.imag * x.imag, full, k)
+            slide(phase, stats, 2, slot, b, n, z, np.angle(x * np.conj(previous[b, n, z]) * bulk), full, k)
+            previous[b, n, z] = x
+    return stats
+
+
+@numba.njit(nogil=True, cache=CACHE)
+def slide(ring, stats, s, slot, b, n, z, new, full, k):
+    # Replaces the oldest sample of a pixel's window, or adds one while it fills, updating its mean stats[s] and sum of
+    # squared deviations stats[s + 1]
+    mean = stats[s, b, n, z]
+    if full:
+        old = ring[slot, b, n, z]
+        updated = mean + (new - old) / k
+        stats[s + 1, b, n, z] += (new - old) * (new - updated + old - mean)
+    else:
+        updated = mean + (new - mean) / k
+        stats[s + 1, b, n, z] += (new - mean) * (new - updated)
+    stats[s, b, n, z] = updated
+    ring[slot, b, n, z] = new
+
+
+@numba.njit(nogil=True, cache=CACHE)
+def quantizeDecibels(X, table, out):
+    """
+    Compiled w numba in nopython mode. Maps complex B-scans to 8-bit dB pixels in one pass, without a logarithm. The
+    power of each pixel is rounded to float32, and the upper 16 bits of the float, its exponent and leading 7 bits of
+    mantissa, index a table of the pixel value of each power. The power is resolved to 0.034 dB, well under a gray level
+    :param X: Complex B-scan, [z, x]
+    :param table: uint8 pixel value of each upper half of a float32 power, [65536]. See OCT.generateDecibelTable
+    :param out: uint8 output, [z, x]
+    :return: out
+    """
+    power = np.empty(1, dtype=np.float32)
+    bits = power.view(np.uint32)
+    for i in range(X.shape[0]):
+        for j in range(X.shape[1]):
+            x = X[i, j]
+            power[0] = x.real * x.real + x.imag * x.imag
+            out[i, j] = table[bits[0] >> 16]
+    return out
+
+
+def serialKernel(kernel):
+    """
+    Compiles a single-threaded copy of a parallel numba kernel with its own on-disk cache. Numba's default threading
+    layer cannot launch parallel kernels from several threads at once, whereas serial copies can run concurrently
+    :param kernel: numba.njit(parallel=True) dispatcher
+    :return: numba.njit dispatcher of the same function without parallel=True
+    """
+    func = kernel.py_func
+    copy = types.FunctionType(func.__code__, func.__globals__, func.__name__ + 'Serial', func.__defaults__,
+                              func.__closure__)
+    copy.__qualname__ = func.__qualname__ + 'Serial'  # Keeps the cache entries of the two versions apart
+    copy.__doc__ = func.__doc__
+    return numba.njit(nogil=True, cache=CACHE)(copy)
+
+
+updateBackground8Serial = serialKernel(updateBackground8)
+preprocess8Serial = serialKernel(preprocess8)
+updateFlow8Serial = serialKernel(updateFlow8)
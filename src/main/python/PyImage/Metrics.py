@@ -0,0 +1,214 @@
+import bisect
+import csv
+import json
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+
+class RollingHistogram:
+    """
+    Histogram of the most recent durations of a stage in log-spaced bins, 20 per decade from 1 us to 10 s. Adding a
+    sample also takes the sample it pushes out of the window back out of its bin, so the histogram follows the current
+    behavior of the pipeline and percentiles cost the same however long a session runs
+    """
+
+    EDGES = list(np.logspace(-6, 1, 141))  # s
+
+    def __init__(self, window=1000):
+        """
+        :param window: Number of samples kept. Default is 1000
+        """
+        self._counts = [0] * (len(self.EDGES) + 1)  # With underflow and overflow bins
+        self._ring = [None] * window
+        self._next = 0
+        self._sum = 0.0
+        self._total = 0  # Samples since the histogram was created
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        b = bisect.bisect(self.EDGES, seconds)
+        with self._lock:
+            old = self._ring[self._next]
+            if old is not None:
+                self._counts[old[0]] -= 1
+                self._sum -= old[1]
+            self._ring[self._next] = (b, seconds)
+            self._next = (self._next + 1) % len(self._ring)
+            self._counts[b] += 1
+            self._sum += seconds
+            self._total += 1
+
+    def getStats(self, percentiles=(50, 95, 99)):
+        """
+        :param percentiles: Percentiles to report
+        :return: Dictionary of the number of samples in total and in the window, and the mean, percentiles and maximum
+                 over the window in ms. Percentiles and maximum are resolved to the geometric center of their bin
+        """
+        with self._lock:
+            counts = list(self._counts)
+            total = self._total
+            mean = self._sum / max(sum(counts), 1)
+        n = sum(counts)
+        stats = {'count': total, 'window': n, 'mean': 1000 * mean}
+        cumulative = np.cumsum(counts)
+        for p in percentiles:
+            stats['p' + str(p)] = self._center(int(np.searchsorted(cumulative, p / 100 * n))) if n else None
+        stats['max'] = self._center(int(np.flatnonzero(counts)[-1])) if n else None
+        return stats
+
+    def _center(self, b):
+        edges = self.EDGES
+        if b == 0:
+            return 1000 * edges[0]
+        if b == len(edges):
+            return 1000 * edges[-1]
+        return 1000 * np.sqrt(edges[b - 1] * edges[b])
+
+
+class PipelineMetrics:
+    """
+    Timing probes, counters and gauges of the acquisition, processing and display threads. Probes are cheap enough to
+    be left in the frame loops: a stage is timed by chaining the time it started into record, which adds the duration
+    to the stage's RollingHistogram and returns the time the next stage starts
+
+        t = time.perf_counter()
+        copy(...)
+        t = metrics.record('copy', t)
+
+    Counters count events such as frames displayed or dropped, and gauges are functions read when a snapshot is taken,
+    i.e. the depth of a queue. The latest snapshots sampled over a session make up its trace, which can be saved as JSON
+    or CSV
+    """
+
+    def __init__(self, window=1000, trace=3600):
+        """
+        :param window: Number of samples kept by the histogram of each stage. Default is 1000
+        :param trace: Number of snapshots kept in the trace, older ones are dropped. Default is 3600, an hour of the
+                      performance panel's samples
+        """
+        self._window = window
+        self._traceLength = trace
+        self._lock = threading.Lock()
+        self.startSession('idle')
+
+    def startSession(self, name, info=None):
+        """
+        Starts a new session with no gauges, histograms, counters or trace
+        :param name: Name of the session, i.e. 'scan' or 'acquire'
+        :param info: Dictionary of parameters of the session stored with its trace
+        """
+        with self._lock:
+            self._session = name
+            self._info = dict(info or {})
+            self._gauges = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Clears the histograms, counters and trace of the session
+        """
+        with self._lock:
+            self._start = time.perf_counter()
+            self._stages = {}
+            self._counters = {}
+            self._trace = deque(maxlen=self._traceLength)
+            self._last = (self._start, {})
+
+    def record(self, stage, start):
+        """
+        :param stage: Name of the stage
+        :param start: perf_counter time the stage started
+        :return: perf_counter time now, i.e. the start of the next stage
+        """
+        now = time.perf_counter()
+        self.add(stage, now - start)
+        return now
+
+    def add(self, stage, seconds):
+        histogram = self._stages.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._stages.setdefault(stage, RollingHistogram(self._window))
+        histogram.add(seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def watch(self, name, function):
+        """
+        :param name: Name of the gauge
+        :param function: Returns the current value, i.e. the depth of a queue. Called by snapshot
+        """
+        with self._lock:
+            self._gauges[name] = function
+
+    def snapshot(self):
+        """
+        :return: Dictionary of the time since the start of the session in s, the stats of each stage, counters, rates
+                 of the counters per s since the previous sample and gauges
+        """
+        now = time.perf_counter()
+        with self._lock:
+            stages = dict(self._stages)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            last, lastCounters = self._last
+        dt = max(now - last, 1e-9)
+        return {
+            'time': now - self._start,
+            'stages': {name: histogram.getStats() for name, histogram in stages.items()},
+            'counters': counters,
+            'rates': {name: (value - lastCounters.get(name, 0)) / dt for name, value in counters.items()},
+            'gauges': {name: function() for name, function in gauges.items()}
+        }
+
+    def sample(self):
+        """
+        Takes a snapshot and adds it to the trace of the session, dropping the oldest once it is full. Rates are over the
+        time since the previous sample
+        :return: The snapshot
+        """
+        snapshot = self.snapshot()
+        with self._lock:
+            self._last = (self._start + snapshot['time'], snapshot['counters'])
+            self._trace.append(snapshot)
+        return snapshot
+
+    def getSession(self):
+        return self._session
+
+    def saveTrace(self, path):
+        """
+        Writes the trace of the session. A .csv file has one row per sample with a column per stat, counter, rate and
+        gauge, anything else is written as JSON along with the name and parameters of the session
+        :param path: Path of the file
+        """
+        with self._lock:
+            trace = list(self._trace)
+            session = {'session': self._session, 'info': self._info}
+        if Path(path).suffix.lower() != '.csv':
+            with open(path, 'w') as f:
+                json.dump(dict(session, trace=trace), f, indent=1, default=float)
+            return
+
+        rows = []
+        for snapshot in trace:
+            row = {'time': snapshot['time']}
+            for name, stats in snapshot['stages'].items():
+                row.update({name + ' ' + stat: value for stat, value in stats.items()})
+            row.update({name: value for name, value in snapshot['counters'].items()})
+            row.update({name + ' /s': value for name, value in snapshot['rates'].items()})
+            row.update({name: value for name, value in snapshot['gauges'].items()})
+            rows.append(row)
+        columns = []
+        for row in rows:
+            columns += [column for column in row if column not in columns]
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
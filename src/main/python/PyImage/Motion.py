@@ -0,0 +1,196 @@
+import threading
+
+import numpy as np
+
+
+def findPeak(correlation):
+    """
+    Locates the maximum of a circular cross-correlation with subpixel precision by fitting a parabola through the peak
+    and its neighbors along each axis
+    :param correlation: Real cross-correlation, any number of dimensions
+    :return: Signed shift along each axis, in pixels. Shifts past half the size wrap around to negative
+    """
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        neighbors = []
+        for step in (-1, 1):
+            index = list(peak)
+            index[axis] = (index[axis] + step) % size
+            neighbors.append(correlation[tuple(index)])
+        center = correlation[peak]
+        curvature = neighbors[0] - 2 * center + neighbors[1]
+        offset = 0.5 * (neighbors[0] - neighbors[1]) / curvature if curvature < 0 else 0.0
+        s = peak[axis] + offset
+        shift.append(s - size if s > size / 2 else s)
+    return shift
+
+
+def axialShift(a, b):
+    """
+    Estimates the axial shift between two complex B-scans already aligned to within a few pixels from the slope of the
+    phase of their cross-spectrum along depth. Unlike the peak of the magnitude correlation, it is unbiased between
+    pixels
+    :param a: Complex B-scan, [z, x]
+    :param b: Complex B-scan of the same shape
+    :return: Shift of a with respect to b along the first axis, in pixels
+    """
+    import scipy.fft  # Deferred like numba, see OCT._kernels
+    cross = np.fft.fftshift(scipy.fft.fft(a, axis=0) * np.conj(scipy.fft.fft(b, axis=0)), axes=0)
+    return -np.angle(np.vdot(cross[:-1], cross[1:])) * a.shape[0] / (2 * np.pi)
+
+
+def overlap(a, b, shift):
+    """
+    :return: Views of a and b cropped to where a is b shifted by the given whole number of pixels along each axis
+    """
+    sa = []
+    sb = []
+    for s in shift:
+        if s > 0:
+            sa.append(slice(s, None))
+            sb.append(slice(None, -s))
+        elif s < 0:
+            sa.append(slice(None, s))
+            sb.append(slice(-s, None))
+        else:
+            sa.append(slice(None))
+            sb.append(slice(None))
+    return a[tuple(sa)], b[tuple(sb)]
+
+
+class MotionTracker:
+    """
+    Estimates the axial and lateral displacement of the sample between successive figure-8s from the complex B-scans.
+    Each B-scan is compared with the same B-scan of the previous frame. The FFT-based cross-correlation of their
+    magnitudes gives the lateral shift and a coarse axial shift with subpixel precision, and the phase of their complex
+    inner product, once aligned, refines the axial shift to a fraction of the wavelength. The spectrum of each
+    magnitude image is kept for the next frame, so a frame costs one forward and one inverse real FFT per B-scan, plus
+    the FFTs along depth of the aligned B-scans.
+
+    Per-frame displacements are accumulated into traces of the last frames, which can be read from another thread.
+    The phase gives the axial step modulo half the center wavelength. The branch is taken nearest a coarse estimate, the
+    whole pixel shift of the correlation peak plus the subpixel shift from the phase slope of the cross-spectrum (see
+    axialShift), so steps of any size are tracked as long as every frame is. Steps where the two estimates disagree by
+    more than a tolerance are left out of the traces, as are B-scans whose magnitudes correlate too poorly with the
+    previous ones, i.e. when the ROI holds no structure.
+    """
+
+    def __init__(self, history=1000, minCorrelation=0.3, tolerance=0.125):
+        """
+        :param history: Number of frames kept in the traces. Default is 1000
+        :param minCorrelation: Lowest normalized cross-correlation peak of a B-scan for its displacement to be used.
+                               Default is 0.3
+        :param tolerance: Largest difference between the coarse and phase estimates of an axial step for it to be used,
+                          in center wavelengths. The nearest branch is never further than a quarter wavelength from the
+                          coarse estimate. Default is 1/8
+        """
+        self._history = history
+        self._minCorrelation = minCorrelation
+        self._tolerance = tolerance
+        self._lock = threading.Lock()
+        self._wavelength = None  # Center wavelength in the sample in um
+        self._axialPixel = None  # um per depth bin
+        self._lateralPixel = None  # um per A-line
+        self.reset()
+
+    def configure(self, lam, alineSpacing, n=1.38):
+        """
+        Sets the scale of the displacements and resets the tracker
+        :param lam: Wavelength in nm at each camera pixel, i.e. the chirp
+        :param alineSpacing: Distance between adjacent A-lines of a B-scan in mm
+        :param n: Refractive index of the sample. Default is 1.38
+        """
+        lam = np.asarray(lam, dtype=np.float64)
+        center = (lam.max() + lam.min()) / 2
+        self._wavelength = center / n * 10 ** -3
+        self._axialPixel = center ** 2 / (2 * n * (lam.max() - lam.min())) * 10 ** -3
+        self._lateralPixel = alineSpacing * 10 ** 3
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the previous frame and clears the traces
+        """
+        with self._lock:
+            self._previous = {}  # B-scan index: (complex B-scan, spectrum and norm of its magnitude, frame)
+            self._time = np.zeros(self._history)
+            self._axial = np.zeros([self._history, 2])
+            self._lateral = np.zeros([self._history, 2])
+            self._position = np.zeros([2, 2])  # Accumulated [axial, lateral] of each B-scan
+            self._count = 0
+            self._start = None
+
+    def update(self, bscans, timestamp, axes=None, frame=None):
+        """
+        :param bscans: Complex B-scans, [z, n, b], or [z, n] for a single B-scan
+        :param timestamp: Time the frame was acquired in s
+        :param axes: Index of each B-scan in the figure-8. Default is 0 to b - 1
+        :param frame: Number of the frame since the start, counting those dropped. A B-scan is then only compared with
+                      that of frame - 1, so that the steps across dropped frames are left out rather than taken as one.
+                      Default is to compare with the previous B-scan whatever its frame
+        :return: Axial and lateral displacement in um of each B-scan since the previous frame, [b, 2]. NaN for a B-scan
+                 without a previous frame or which correlates too poorly with it
+        """
+        import scipy.fft  # Deferred like numba, see OCT._kernels
+        if bscans.ndim == 2:
+            bscans = bscans[:, :, None]
+        if axes is None:
+            axes = range(bscans.shape[2])
+
+        displacement = np.full([bscans.shape[2], 2], np.nan)
+        for i, axis in enumerate(axes):
+            bscan = bscans[:, :, i]
+            magnitude = np.abs(bscan)
+            magnitude -= magnitude.mean()
+            spectrum = scipy.fft.rfft2(magnitude)
+            norm = np.linalg.norm(magnitude)
+            previous = self._previous.get(axis)
+            self._previous[axis] = (bscan.copy(), spectrum, norm, frame)
+            if previous is None or previous[0].shape != bscan.shape:
+                continue
+            if frame is not None and previous[3] != frame - 1:
+                continue
+            correlation = scipy.fft.irfft2(spectrum * np.conj(previous[1]), s=magnitude.shape)
+            if correlation.max() < self._minCorrelation * norm * previous[2]:
+                continue
+            dz, dx = findPeak(correlation)
+
+            # The phase of the B-scans, aligned by whole pixels, gives the axial shift modulo half a wavelength, on the
+            # branch nearest the coarse shift. Each whole pixel of alignment adds half a turn, as the phase of a bin is
+            # referenced to the first wavenumber rather than the center one
+            shift = (int(round(dz)), int(round(dx)))
+            a, b = overlap(bscan, previous[0], shift)
+            coarse = (shift[0] + axialShift(a, b)) * self._axialPixel
+            phase = np.angle(np.vdot(b, a)) + np.pi * shift[0]
+            period = self._wavelength / 2
+            fine = phase / (2 * np.pi) * period
+            step = fine + round((coarse - fine) / period) * period
+            if abs(step - coarse) > self._tolerance * self._wavelength:
+                continue
+            displacement[i, 0] = step
+            displacement[i, 1] = dx * self._lateralPixel
+
+        with self._lock:
+            if self._start is None:
+                self._start = timestamp
+            for i, axis in enumerate(axes):
+                if not np.isnan(displacement[i, 0]):
+                    self._position[axis] += displacement[i]
+            j = self._count % self._history
+            self._time[j] = timestamp - self._start
+            self._axial[j] = self._position[:, 0]
+            self._lateral[j] = self._position[:, 1]
+            self._count += 1
+        return displacement
+
+    def getTraces(self):
+        """
+        :return: time: Time of each frame since the first in s
+                 axial: Accumulated axial displacement of each B-scan in um, [frames, 2]
+                 lateral: Accumulated lateral displacement of each B-scan along its own axis in um, [frames, 2]
+        """
+        with self._lock:
+            n = min(self._count, self._history)
+            order = (np.arange(n) + self._count - n) % self._history
+            return self._time[order], self._axial[order], self._lateral[order]
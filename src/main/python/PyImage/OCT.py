@@ -1,6 +1,8 @@
+import functools
+import threading
+import time
+
 import numpy as np
-import numba
-from scipy.interpolate import interp1d
 
 
 def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angle=np.pi / 4, flyback=20, flybackAngle=np.pi / 2.58):
@@ -19,6 +21,7 @@ def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angl
              B2: Indices of second B-scan
              N: Total number of A-scans in the pattern
              D: Distance between adjacent A-scans in the B-scans
+             idx: Index map of the A-scans in each B-scan, [b, n]. See generateBScanIndexMaps
     """
     fbscale = 2
     xsize = np.sqrt(2) / 4 * xdistance * (alinesPerX - 1)
@@ -61,29 +64,284 @@ def generateIdealFigureEightPositions(xdistance, alinesPerX, rpt=1, padB=0, angl
 
         N = len(X)
 
-        return [posRpt, X, Y, b1, b2, N, D]
+        idx = generateBScanIndexMaps([b1, b2])
+
+        return [posRpt, X, Y, b1, b2, N, D, idx]
+
+
+def generateBScanIndexMaps(masks):
+    """
+    Converts boolean B-scan masks into a compact integer index map
+    :param masks: List of boolean arrays of size N, one per B-scan, each with the same number of True elements
+    :return: idx: [b, n] array where row b holds the indices of the A-scans in B-scan b, in acquisition order
+    """
+    return np.array([np.flatnonzero(mask) for mask in masks], dtype=np.int64)
+
+
+def _kernels():
+    # numba is only imported, and the compiled kernels loaded, the first time a frame is processed
+    from src.main.python.PyImage import Kernels
+    return Kernels
+
+
+def updateBackground8(A, B, alpha, bg):
+    """
+    Folds the mean spectrum of the B-scans of a raw figure-8 into a background estimate in place. See
+    Kernels.updateBackground8
+    :return: bg
+    """
+    return _kernels().updateBackground8(A, B, alpha, bg)
+
+
+def updateBackground8Serial(A, B, alpha, bg):
+    """
+    Single-threaded updateBackground8, which can run on several threads at once
+    :return: bg
+    """
+    return _kernels().updateBackground8Serial(A, B, alpha, bg)
+
+
+def preprocess8(A, B, window, i0, i1, w, out):
+    """
+    Extracts, normalizes, apodizes and resamples the B-scans of a raw figure-8 in one pass. See Kernels.preprocess8
+    :return: out
+    """
+    return _kernels().preprocess8(A, B, window, i0, i1, w, out)
+
+
+def preprocess8Serial(A, B, window, i0, i1, w, out):
+    """
+    Single-threaded preprocess8, which can run on several threads at once
+    :return: out
+    """
+    return _kernels().preprocess8Serial(A, B, window, i0, i1, w, out)
+
+
+def updateFlow8(X, previous, intensity, phase, slot, count, stats):
+    """
+    Adds a frame of complex B-scans to sliding windows of intensity and bulk-corrected phase difference at each pixel.
+    See Kernels.updateFlow8
+    :return: stats
+    """
+    return _kernels().updateFlow8(X, previous, intensity, phase, slot, count, stats)
+
+
+def updateFlow8Serial(X, previous, intensity, phase, slot, count, stats):
+    """
+    Single-threaded updateFlow8, which can run on several threads at once
+    :return: stats
+    """
+    return _kernels().updateFlow8Serial(X, previous, intensity, phase, slot, count, stats)
+
+
+def quantizeDecibels(X, table, out):
+    """
+    Maps complex B-scans to 8-bit dB pixels with a table from generateDecibelTable. See Kernels.quantizeDecibels
+    :return: out
+    """
+    return _kernels().quantizeDecibels(X, table, out)
+
+
+def generateDecibelTable(levels):
+    """
+    Precomputes the 8-bit pixel value of every power a complex pixel can have in float32, for quantizeDecibels. The
+    powers are indexed by the upper 16 bits of their float32 representation, and each is taken at the middle of the
+    range of floats sharing those bits
+    :param levels: dB mapped to black and white, (black, white)
+    :return: uint8 table, [65536]
+    """
+    bits = (np.arange(65536, dtype=np.uint32) << 16) | 0x8000
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        power = bits.view(np.float32).astype(np.float64)
+        pixels = (10 * np.log10(power) - levels[0]) * 255 / (levels[1] - levels[0])
+    pixels[~(power >= 0)] = 0  # Negative and NaN halves, which squares don't have
+    return np.clip(np.nan_to_num(pixels, posinf=255, neginf=0), 0, 255).astype(np.uint8)
+
+
+def generateInterpolationTables(lam, n=2048):
+    """
+    Precomputes the linear interpolation used to resample spectra from the wavelength of each camera pixel onto a
+    linearly spaced axis. Equivalent to interp1d(lam, spectrum)(np.linspace(min(lam), max(lam), n)) for every A-line,
+    but only has to be built once per chirp.
+    :param lam: Wavelength at each camera pixel, i.e. the chirp
+    :param n: Number of points in the resampled axis. Default is 2048
+    :return: i0: Index of the lower neighbor pixel of each resampled point
+             i1: Index of the upper neighbor pixel of each resampled point
+             w: Weight of the upper neighbor. The lower neighbor is weighted by 1 - w
+    """
+    lam = np.asarray(lam, dtype=np.float64)
+    order = np.argsort(lam, kind='mergesort')
+    x = lam[order]
+    xi = np.linspace(x[0], x[-1], n)
+    j = np.clip(np.searchsorted(x, xi, side='right') - 1, 0, len(x) - 2)
+    w = (xi - x[j]) / (x[j + 1] - x[j])
+    return [order[j], order[j + 1], w]
+
+
+def fftBScan(A, axis=0, workers=1):
+    """
+    Transforms a block of real spectra into complex A-lines. Equivalent to np.fft.ifft(A[:, n])[0:1024] for every
+    A-line, but uses a single real-input transform which only computes the half of the spectrum that is kept.
+    scipy.fft caches the plan for each transform length, so repeated calls on blocks of the same shape reuse it.
+    :param A: Real spectra, i.e. [2048, n], [2048, n, b] or [b, n, 2048]
+    :param axis: Spectral axis of A. Default is 0
+    :param workers: Number of threads to split the transform across. Default is 1
+    :return: Complex A-lines, with the spectral axis reduced to 1024 depth bins
+    """
+    import scipy.fft  # Deferred like numba, see _kernels
+    transformed = scipy.fft.ihfft(A, axis=axis, workers=workers)
+    keep = [slice(None)] * A.ndim
+    keep[axis] = slice(0, A.shape[axis] // 2)
+    return transformed[tuple(keep)].astype(np.complex64)
+
+
+@functools.lru_cache(maxsize=8)
+def generateDepthTransform(top, bottom, n=2048):
+    """
+    Precomputes the rows of the inverse DFT of real spectra that give the depth bins of an axial ROI, so that only those
+    bins are computed. The real and imaginary parts of each bin are interleaved, so that the product of spectra with
+    the matrix is the complex A-lines in place. Cached for the last few ROIs
+    :param top: First depth bin
+    :param bottom: Depth bin after the last
+    :param n: Length of the spectra. Default is 2048
+    :return: float32 [n, 2 * (bottom - top)] matrix. Read-only
+    """
+    angle = 2 * np.pi * np.outer(np.arange(n), np.arange(top, bottom)) / n
+    matrix = np.empty([n, 2 * (bottom - top)], dtype=np.float32)
+    matrix[:, 0::2] = np.cos(angle) / n
+    matrix[:, 1::2] = np.sin(angle) / n
+    matrix.flags.writeable = False
+    return matrix
+
+
+def dftBScan(A, ROI):
+    """
+    Transforms a block of real spectra into the depth bins of an axial ROI with a single matrix product. Equivalent to
+    fftBScan(A, axis=-1)[..., ROI[0]:ROI[1]], but its cost is proportional to the depth of the ROI, so narrow ROIs are
+    faster than a full FFT. The product is single precision, which is well below the noise floor of the complex64
+    A-lines
+    :param A: Real float32 spectra, [..., 2048]
+    :param ROI: Axial range of depth bins, (top, bottom)
+    :return: Complex A-lines, [..., bottom - top]
+    """
+    matrix = generateDepthTransform(ROI[0], ROI[1], A.shape[-1])
+    return np.matmul(A.reshape(-1, A.shape[-1]), matrix).view(np.complex64).reshape(A.shape[:-1] + (-1,))
+
+
+_depthTransformCosts = {}  # (A-lines, workers): (FFT time, DFT time without and per depth bin) in s
+_depthTransformLock = threading.Lock()
+
+
+def chooseDepthTransform(lines, depth, workers=1, repeats=5):
+    """
+    Picks the faster of fftBScan and dftBScan for the depth of an ROI. The FFT costs the same whatever the ROI while the
+    matrix product grows with its depth, so both are timed once per number of A-lines on random spectra, the product
+    at two depths to fit its cost per bin, and the choice for any ROI is read off the fit
+    :param lines: Number of A-lines transformed at once
+    :param depth: Number of depth bins in the ROI
+    :param workers: Number of threads the FFT is split across. Default is 1
+    :param repeats: Timed calls of each transform. The fastest is used. Default is 5
+    :return: 'fft' or 'dft'
+    """
+    if depth < 1:
+        return 'fft'
+    with _depthTransformLock:
+        costs = _depthTransformCosts.get((lines, workers))
+        if costs is None:
+            spectra = np.random.rand(lines, 2048)
+            spectra32 = spectra.astype(np.float32)
+
+            def fastest(function):
+                times = []
+                for i in range(repeats + 1):  # The first call plans the FFT or allocates the matrix
+                    start = time.perf_counter()
+                    function()
+                    times.append(time.perf_counter() - start)
+                return min(times[1:])
 
+            fft = fastest(lambda: fftBScan(spectra, axis=-1, workers=workers))
+            narrow = fastest(lambda: dftBScan(spectra32, (0, 16)))
+            wide = fastest(lambda: dftBScan(spectra32, (0, 128)))
+            perBin = max(wide - narrow, 0) / 112
+            costs = (fft, narrow - 16 * perBin, perBin)
+            _depthTransformCosts[(lines, workers)] = costs
+    fft, fixed, perBin = costs
+    return 'dft' if fixed + perBin * depth < fft else 'fft'
 
-@numba.jit(forceobj=True)
-def preprocess8(A,N,B,AlinesPerX,apod):
+
+def reconstruct8(A, B, window, interpTables, ROI, workers=1, parallel=True, metrics=None, transform='auto'):
     """
-    Compiled w numba. Reshapes raw figure-8 OCT data into a B scan
+    Reconstructs complex B-scans from a raw figure-8
     :param A: Raw uint16 OCT spectral data
-    :param N: The total number of A-scans in each figure-8
-    :param B: Boolean array of indices size N indicating B-scan
-    :param AlinesPerX: Number of A-scans in the B-scan
-    :param apod: Apodization window
-    :return: 2D Preprocessed data, [z,n] where z is axial dimension, n is lateral A-scans
-    """
-    flattened = A.flatten()
-    pp = np.empty([2048,AlinesPerX],dtype=np.double)
-    i = 0
-    for n in np.arange(N):
-        if B[n]:
-            pp[:, i] = flattened[2048 * n:2048 * n + 2048]
-            i += 1
-    dc = np.mean(pp, axis=1)
-    window = apod / dc
-    for n in np.arange(AlinesPerX):
-        pp[:,n] = pp[:, n] * window
-    return pp
\ No newline at end of file
+    :param B: Index map of the A-scans in each B-scan, [b, n], or [n] for a single B-scan
+    :param window: Apodization window divided by the background spectrum, [b, 2048] or [1, 2048]
+    :param interpTables: Resampling tables from generateInterpolationTables
+    :param ROI: Axial range of depth bins to keep, (top, bottom)
+    :param workers: Number of threads to split the FFT across. Default is 1
+    :param parallel: If False, the single-threaded kernel is used so that several threads can reconstruct at once.
+                     Default is True
+    :param metrics: PipelineMetrics the preprocess and fft stages are timed into. Default is None
+    :param transform: 'fft' transforms all 1024 depth bins and crops them to the ROI, 'dft' only computes the ROI with
+                      dftBScan, and 'auto' picks the faster for the ROI with chooseDepthTransform. Default is 'auto'
+    :return: Complex B-scans, [z, n, b], or [z, n] if B is a single B-scan
+    """
+    start = time.perf_counter()
+    idx = np.atleast_2d(B)
+    top, bottom = min(ROI[0], 1024), min(ROI[1], 1024)
+    if transform == 'auto':
+        transform = chooseDepthTransform(idx.size, bottom - top, workers=workers if parallel else 1)
+    # The matrix product is single precision, so the spectra are resampled straight into float32
+    spectra = np.empty([idx.shape[0], idx.shape[1], 2048], dtype=np.float32 if transform == 'dft' else np.float64)
+
+    if parallel:
+        preprocess8(A.reshape(-1, 2048), idx, window, *interpTables, spectra)
+    else:
+        preprocess8Serial(A.reshape(-1, 2048), idx, window, *interpTables, spectra)
+    if metrics is not None:
+        start = metrics.record('preprocess', start)  # Extraction, apodization and resampling are one kernel
+    if transform == 'dft':
+        processed = dftBScan(spectra, (top, bottom)).T  # [z, n, b]
+    else:
+        processed = fftBScan(spectra, axis=-1, workers=workers).T[top:bottom]
+    if metrics is not None:
+        metrics.record('fft', start)
+
+    if B.ndim == 1:
+        processed = processed[:, :, 0]
+
+    return processed
+
+
+def warmUp(alinesPerX=100, padB=20, flyback=50, workers=1):
+    """
+    Compiles the reconstruction and flow contrast kernels, or loads them from numba's on-disk cache, plans the FFT and
+    picks the depth transform with a synthetic figure-8 of the argument types the GUI processes frames with. Meant to
+    run in the background at startup so that the first frame after SCAN doesn't pay for it
+    :param alinesPerX: A-lines per B-scan of the synthetic figure-8, including padding. Default is 100
+    :param padB: B-scan padding. Default is 20
+    :param flyback: A-lines per flyback. Default is 50
+    :param workers: Number of threads the GUI splits the FFT across. Default is 1
+    :return: Seconds taken
+    """
+    start = time.perf_counter()
+    [pos, X, Y, b1, b2, N, D, idx] = generateIdealFigureEightPositions(0.003, alinesPerX, padB=padB, flyback=flyback)
+    interpTables = generateInterpolationTables(1 / np.linspace(1 + 0.19 / 2, 1 - 0.19 / 2, 2048))
+    A = np.random.randint(500, 4000, size=[N, 2048]).astype(np.uint16)
+    for parallel in [True, False]:
+        update = updateBackground8 if parallel else updateBackground8Serial
+        for B in [idx, idx[0]]:
+            window = np.hanning(2048) / update(A, np.atleast_2d(B), 1.0, np.empty([np.atleast_2d(B).shape[0], 2048]))
+            for transform in ['fft', 'dft']:  # float64 and float32 spectra
+                reconstruct8(A, B, window, interpTables, (8, 400), parallel=parallel, transform=transform)
+            bscan = reconstruct8(A, B, window, interpTables, (8, 400), workers=workers if parallel else 1,
+                                 parallel=parallel)
+        # Flow contrast kernels, with the B-scans expanded to [z, n, b] as FlowContrast passes them
+        flow = updateFlow8 if parallel else updateFlow8Serial
+        z, n, b = bscan[:, :, None].shape
+        flow(bscan[:, :, None], np.zeros([b, n, z], dtype=np.complex64), np.zeros([2, b, n, z], dtype=np.float32),
+             np.zeros([2, b, n, z], dtype=np.float32), 0, 0, np.zeros([4, b, n, z]))
+    # B-scan display, strided for a single B-scan and contiguous for both side by side
+    table = generateDecibelTable((-100, -2))
+    quantizeDecibels(bscan, table, np.empty(bscan.shape, dtype=np.uint8))
+    quantizeDecibels(np.ascontiguousarray(bscan), table, np.empty(bscan.shape, dtype=np.uint8))
+    return time.perf_counter() - start
@@ -0,0 +1,163 @@
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from src.main.python.PyImage.Buffers import FramePool
+from src.main.python.PyImage.OCT import reconstruct8
+
+
+def createShared(shape, dtype):
+    """
+    :return: SharedMemory block and an array of the given shape and dtype backed by it
+    """
+    nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def attachShared(name, shape, dtype):
+    """
+    :return: Existing SharedMemory block and an array of the given shape and dtype backed by it
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def releaseShared(shm, unlink=False):
+    try:
+        shm.close()
+    except BufferError:
+        pass  # Views of the block are still alive, it is closed once they are collected
+    if unlink:
+        shm.unlink()
+
+
+class SharedFramePool(FramePool):
+    """
+    FramePool whose slots live in a multiprocessing.shared_memory block so that worker processes can read frames
+    without them being pickled. The number of samples in a frame is fixed when the pool is created
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint16):
+        super().__init__(slots, dtype=dtype)
+        self._shape = tuple(shape)
+        self._shm, self._frames = createShared((slots,) + self._shape, dtype)
+        for slot in range(slots):
+            self._free.put(slot)
+
+    def allocate(self, shape):
+        # Only views the slots with the shape of the raw data, the shared block cannot be resized
+        shape = tuple(shape)
+        if int(np.prod(shape)) != int(np.prod(self._shape)):
+            raise ValueError('Raw frames of shape ' + str(shape) + ' do not fit slots of shape ' + str(self._shape))
+        self._frames = self._frames.reshape((self._slots,) + shape)
+
+    def getName(self):
+        return self._shm.name
+
+    def getShape(self):
+        return (self._slots,) + self._shape
+
+    def close(self):
+        self._frames = None
+        releaseShared(self._shm, unlink=True)
+
+
+def reconstructWorker(framesName, framesShape, windowsName, windowsShape, outName, outShape, idx, interpTables, roi,
+                      tasks, results):
+    """
+    Worker process of ProcessPipeline. Frames, windows and results are exchanged through shared memory, the queues only
+    carry (slot, sequence number, timestamp) descriptors
+    """
+    framesShm, frames = attachShared(framesName, framesShape, np.uint16)
+    windowsShm, windows = attachShared(windowsName, windowsShape, np.float64)
+    outShm, out = attachShared(outName, outShape, np.complex64)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, seq, timestamp = task
+        out[slot] = reconstruct8(frames[slot], idx, windows[slot], interpTables, roi, parallel=False)
+        results.put(task)
+    del frames, windows, out
+    for shm in [framesShm, windowsShm, outShm]:
+        releaseShared(shm)
+
+
+class ProcessPipeline:
+    """
+    Reconstructs frames from a SharedFramePool in separate worker processes, outside of the GIL of the acquisition and
+    GUI threads. Each frame slot has a matching window slot and output slot in shared memory. Results are handed back
+    in submission order
+    """
+
+    def __init__(self, pool, workers, idx, interpTables, roi):
+        """
+        :param pool: SharedFramePool the frames are acquired into
+        :param workers: Number of worker processes
+        :param idx: Index map of the A-scans in each B-scan, [b, n]
+        :param interpTables: Resampling tables from generateInterpolationTables
+        :param roi: Axial range of depth bins to keep, (top, bottom)
+        """
+        slots = pool.getShape()[0]
+        self._windowsShm, self._windows = createShared((slots, idx.shape[0], 2048), np.float64)
+        self._outShm, self._out = createShared((slots, roi[1] - roi[0], idx.shape[1], idx.shape[0]), np.complex64)
+        context = multiprocessing.get_context('spawn')  # Forking a process with Qt and camera threads is unsafe
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._processes = []
+        for i in range(workers):
+            process = context.Process(target=reconstructWorker,
+                                      args=(pool.getName(), pool.getShape(),
+                                            self._windowsShm.name, self._windows.shape,
+                                            self._outShm.name, self._out.shape,
+                                            idx, interpTables, roi, self._tasks, self._results))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+        self._submitted = 0
+        self._collected = 0
+        self._finished = {}  # Reorder buffer of sequence number: slot
+        self._latency = 0
+
+    def submit(self, slot, window):
+        """
+        :param slot: Slot of the pool holding the raw frame
+        :param window: Apodization window divided by the background spectrum, [b, 2048] or [1, 2048]
+        """
+        self._windows[slot] = window
+        self._tasks.put((slot, self._submitted, time.time()))
+        self._submitted += 1
+
+    def getPending(self):
+        return self._submitted - self._collected
+
+    def getLatency(self):
+        # Time from submission to completion of the last frame collected
+        return self._latency
+
+    def next(self, timeout=None):
+        """
+        Waits for the oldest frame submitted. The slot must be released to the pool once the result has been used
+        :return: slot: Slot of the frame
+                 out: Reconstructed B-scans, [z, n, b], a view of shared memory
+        """
+        while self._collected not in self._finished:
+            slot, seq, timestamp = self._results.get(timeout=timeout)
+            self._finished[seq] = (slot, timestamp)
+        slot, timestamp = self._finished.pop(self._collected)
+        self._latency = time.time() - timestamp
+        self._collected += 1
+        return slot, self._out[slot]
+
+    def close(self):
+        for process in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join()
+        self._windows = None
+        self._out = None
+        releaseShared(self._windowsShm, unlink=True)
+        releaseShared(self._outShm, unlink=True)
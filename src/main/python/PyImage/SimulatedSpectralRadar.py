@@ -0,0 +1,263 @@
+"""
+Simulated Telesto, for running and benchmarking the GUI without the device or the SpectralRadar SDK. Implements the
+part of PySpectralRadar that FigureEight uses, and is selected in its place by setting the environment variable
+PYIMAGEOCT_DEVICE to 'simulated'.
+
+Raw frames are synthesized from the scan pattern: the source spectrum on a nonlinear chirp, interfering with a layered
+sample whose surface depth depends on the scan position, fixed speckle-like scatterers below it and a slight
+sinusoidal axial motion. A bank of frames is synthesized when a measurement starts and cycled through, and frames are
+delivered at the line rate of the camera preset, 76 or 146 kHz. Frames that aren't collected before they drop out of
+the device buffer are lost, as with the device, and counted.
+"""
+
+import threading
+import time
+from enum import IntEnum
+
+import numpy as np
+
+PIXELS = 2048
+LINE_RATES = [76000, 146000]  # Hz, by camera preset
+BUFFER_FRAMES = 4  # Frames held for the caller before the oldest is lost
+BANK_FRAMES = 16  # Distinct frames cycled through. One period of the axial motion
+MOTION = 0.0005  # Amplitude of the axial motion in mm
+
+LAYERS = [(0.0, 0.05), (0.12, 0.02), (0.35, 0.01)]  # Depth below the surface in mm and reflectivity
+SCATTERERS = 24  # Per A-line, within 0.8 mm of the surface
+
+
+class Device_TriggerType(IntEnum):
+    Trigger_FreeRunning = 0
+    Trigger_TrigBoard_ExternalStart = 1
+    Trigger_External_AScan = 2
+
+
+class AcquisitionType(IntEnum):
+    Acquisition_AsyncContinuous = 0
+    Acquisition_AsyncFinite = 1
+    Acquisition_Sync = 2
+
+
+class DevicePropertyString(IntEnum):
+    Device_Type = 0
+    Device_Series = 1
+    Device_SerialNumber = 2
+
+
+class _Device:
+
+    def __init__(self):
+        self.lineRate = LINE_RATES[0]
+        self.lam = generateChirp()
+        self.lock = threading.Lock()
+        self.pattern = None  # Pattern being measured
+        self.start = None
+        self.next = 0
+        self.delivered = 0
+        self.lost = 0
+
+
+class _Probe:
+
+    def __init__(self, config):
+        self.config = config
+
+
+class _ScanPattern:
+
+    def __init__(self, positions, size):
+        self.x = positions[0::2][:size]
+        self.y = positions[1::2][:size]
+        self.size = size
+        self.bank = None  # Synthesized by the first measurement
+
+
+class _RawData:
+
+    def __init__(self):
+        self.frame = None
+
+
+def generateChirp(n=PIXELS):
+    """
+    :return: Wavelength in nm at each camera pixel, slightly nonlinear like a spectrometer's
+    """
+    u = np.linspace(0, 1, n)
+    return 1225 + 160 * u + 8 * u * (1 - u)
+
+
+def synthesizeFrames(x, y, lam, count=BANK_FRAMES, seed=0):
+    """
+    Synthesizes raw figure-8 frames. The interference is computed on a uniform wavenumber grid with an inverse FFT
+    and interpolated onto the chirp of the camera pixels
+    :param x: X position of each A-line in mm
+    :param y: Y position of each A-line in mm
+    :param lam: Wavelength in nm at each camera pixel
+    :param count: Number of frames, over which the axial motion completes one period
+    :param seed: Seed of the scatterers and noise
+    :return: Raw uint16 frames, [count, N, 2048]
+    """
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    k = 2 * np.pi / (lam * 10 ** -6)  # rad/mm
+    grid = 2 * len(lam)
+    dk = (k.max() - k.min()) / (grid - 1)
+    zPerBin = np.pi / (dk * grid)
+    j = (k - k.min()) / dk
+    j0 = np.clip(np.floor(j).astype(np.int64), 0, grid - 2)
+    wj = j - j0
+
+    surface = 0.8 + 0.1 * x + 0.05 * np.sin(2 * np.pi * y / 0.5)
+    offsets = np.concatenate([np.tile([depth for depth, r in LAYERS], (n, 1)),
+                              rng.uniform(0.02, 0.8, size=[n, SCATTERERS])], axis=1)
+    amplitudes = np.concatenate([np.tile([r for depth, r in LAYERS], (n, 1)),
+                                 0.004 * rng.rayleigh(size=[n, SCATTERERS])], axis=1)
+    phases = np.concatenate([np.zeros([n, len(LAYERS)]), rng.uniform(0, 2 * np.pi, size=[n, SCATTERERS])], axis=1)
+    rows = np.repeat(np.arange(n)[:, None], offsets.shape[1], axis=1)
+
+    pixel = np.arange(len(lam))
+    dc = 600 + 2600 * np.exp(-((pixel - len(lam) / 2) / (0.3 * len(lam))) ** 2)
+
+    # The sample at rest. Reflectors are placed on the nearest bin of the grid, with the phase of their exact depth
+    z = surface[:, None] + offsets
+    profile = np.zeros([n, grid], dtype=np.complex128)
+    np.add.at(profile, (rows, np.rint(z / zPerBin).astype(np.int64)),
+              amplitudes * np.exp(1j * (2 * k.min() * z + phases)))
+    rest = grid * np.fft.ifft(profile, axis=1)
+
+    # The axial motion moves the whole sample, which multiplies the interference at each wavenumber by exp(2ik * dz).
+    # Unlike moving the reflectors on the grid, this is exact for displacements of any size
+    kGrid = k.min() + dk * np.arange(grid)
+    frames = np.empty([count, n, len(lam)], dtype=np.uint16)
+    for f in range(count):
+        fringes = (rest * np.exp(2j * kGrid * MOTION * np.sin(2 * np.pi * f / count))).real
+        fringes = fringes[:, j0] * (1 - wj) + fringes[:, j0 + 1] * wj
+        raw = dc * (1 + fringes) + rng.normal(0, 4, size=fringes.shape)
+        frames[f] = np.clip(raw, 0, 4095)  # 12-bit camera
+    return frames
+
+
+def initDevice():
+    return _Device()
+
+
+def closeDevice(device):
+    stopMeasurement(device)
+
+
+def initProbe(device, config):
+    return _Probe(config)
+
+
+def closeProbe(probe):
+    pass
+
+
+def createProcessingForDevice(device):
+    return object()
+
+
+def closeProcessing(proc):
+    pass
+
+
+def setCameraPreset(device, probe, proc, preset):
+    device.lineRate = LINE_RATES[preset]
+
+
+def setTriggerMode(device, triggerType):
+    pass
+
+
+def setTriggerTimeoutSec(device, timeout):
+    pass
+
+
+def setComplexDataOutput(proc, complexDataHandle):
+    pass
+
+
+def getDevicePropertyString(device, prop):
+    return 'Simulated'
+
+
+def getWavelengthAtPixel(device, pixel):
+    return float(device.lam[pixel])
+
+
+def createFreeformScanPattern(probe, positions, size, loops, apodization):
+    return _ScanPattern(np.asarray(positions), size)
+
+
+def clearScanPattern(scanPattern):
+    if scanPattern is not None:
+        scanPattern.bank = None
+
+
+def startMeasurement(device, scanPattern, acquisitionType):
+    if scanPattern.bank is None:
+        scanPattern.bank = synthesizeFrames(scanPattern.x, scanPattern.y, device.lam)
+    with device.lock:
+        device.pattern = scanPattern
+        device.next = 0
+        device.start = time.perf_counter()
+
+
+def stopMeasurement(device):
+    with device.lock:
+        device.pattern = None
+
+
+def createRawData():
+    return _RawData()
+
+
+def clearRawData(rawData):
+    rawData.frame = None
+
+
+def getRawData(device, rawData):
+    """
+    Waits for the next frame. If the caller fell behind by more than the device buffer, the frames in between are lost
+    """
+    with device.lock:
+        pattern = device.pattern
+        if pattern is None:
+            rawData.frame = None
+            return
+        period = pattern.size / device.lineRate
+        i = device.next
+        start = device.start
+    now = time.perf_counter()
+    ready = start + (i + 1) * period
+    if ready > now:
+        time.sleep(ready - now)
+    else:
+        oldest = int((now - start) / period) - BUFFER_FRAMES
+        if i < oldest:
+            with device.lock:
+                device.lost += oldest - i
+            i = oldest
+    with device.lock:
+        device.next = i + 1
+        device.delivered += 1
+    rawData.frame = pattern.bank[i % len(pattern.bank)]
+
+
+def getRawDataShape(rawData):
+    if rawData.frame is None:
+        return [0, 0, 0]
+    return [PIXELS, rawData.frame.shape[0], 1]
+
+
+def copyRawDataContent(rawData, destination):
+    destination.reshape(-1)[:] = rawData.frame.reshape(-1)
+
+
+def getStatistics(device):
+    """
+    Not part of PySpectralRadar
+    :return: delivered: Number of frames returned by getRawData
+             lost: Number of frames lost because getRawData wasn't called in time
+    """
+    return device.delivered, device.lost
@@ -1,18 +1,36 @@
 import os
 import time
 import threading
-from copy import deepcopy
-from queue import Queue, Full
+from collections import deque
+from queue import Queue, Empty
 
-import h5py
 from PyQt5.QtWidgets import QWidget, QGridLayout
+from PyQt5.QtCore import QObject, pyqtSignal
 from pyqtgraph.Qt import QtGui
 
-from src.main.python.PySpectralRadar import PySpectralRadar
+if os.environ.get('PYIMAGEOCT_DEVICE') == 'simulated':
+    from src.main.python.PyImage import SimulatedSpectralRadar as PySpectralRadar
+else:
+    from src.main.python.PySpectralRadar import PySpectralRadar
 from src.main.python.PyImage import Widgets
+from src.main.python.PyImage.Buffers import FramePool, OrderedWorkerPool, Mailbox
+from src.main.python.PyImage.Cache import LRUCache, CalibrationStore
+from src.main.python.PyImage.Metrics import PipelineMetrics
+from src.main.python.PyImage.Motion import MotionTracker
+from src.main.python.PyImage.Flow import FlowContrast
+from src.main.python.PyImage.ProcessPipeline import SharedFramePool, ProcessPipeline
+from src.main.python.PyImage.Export import HDFWriter, NpyWriter, RawWriter
 from src.main.python.PyImage.OCT import *
 
 
+class ControllerSignals(QObject):
+    """
+    Signals that let the device and processing threads update the GUI. Connected widget methods run on the GUI thread
+    """
+
+    widgetsEnabled = pyqtSignal(bool)
+
+
 class FigureEight:
 
     def __init__(self, parent):
@@ -22,6 +40,9 @@ class FigureEight:
         self._fileExperimentDirectory = None
         self._fileMaxSize = None
         self._fileType = None
+        self._hdfChunks = None  # One figure-8 per chunk
+        self._hdfCompression = 'lzf'
+        self._hdfCompressionOpts = None
 
         # Scan pattern params
         self._scanPatternSize = None
@@ -39,6 +60,9 @@ class FigureEight:
         self.scanPatternB2 = None
         self.scanPatternN = None
         self.scanPatternD = None
+        self.scanPatternIdx = None
+        self._scanPatternKey = None
+        self._patternGeometry = LRUCache(32)  # Generated geometry by pattern params
 
         # ROI
         self._roi_z = (None, None)
@@ -48,23 +72,59 @@ class FigureEight:
         self._rateEnum = 0
         self._config = "ProbeLKM10-LV"  # TODO un-hardcode default
         self._apodWindow = None
-        self._displayAxis = 0
+        self._displayAxis = None
+
+        # Background spectrum
+        self._backgroundMode = 'Per-frame'
+        self._backgroundWindow = None  # Apodization window / background
+        self._referenceBackground = None  # [1, 2048], pooled over all B-scans
+        self._referenceCount = 0
+        self._referenceFrames = 50  # Number of frames averaged into the reference background
+        self._rollingBackground = None  # [1, 2048], pooled over all B-scans
+        self._rollingAlpha = 0.05  # Weight of each new frame in the rolling average
+
+        # Motion quantification
+        self.motion = MotionTracker()
+        self._motionEnabled = False
+        self._refractiveIndex = 1.38
+
+        # Flow contrast
+        self.flow = FlowContrast()
+        self._flowMode = 'Off'
+        self._flowLevels = {'Speckle variance': (0, 1), 'Phase variance': (0, np.pi ** 2 / 3)}
+        self._flowWriters = None
 
         # SpectralRadar handles
         self._device = None
         self._probe = None
         self._proc = None
         self._scanPattern = None
+        self._scanPatterns = LRUCache(8, onEvict=PySpectralRadar.clearScanPattern)  # By pattern params and probe
         self._triggerType = None
         self._acquisitionType = None
         self._triggerTimeout = None
         self._lam = None
+        self._interpTables = None
+        self._calibration = CalibrationStore()
+        self._deviceIdentity = None
 
         # OS
         self._threads = []
+        self._initThread = None
+        self._warmUpThread = None
+        self._acquireThread = None
+        self._scanStartTime = None  # For the time to first B-scan
+        self._fftWorkers = os.cpu_count()
+        self._processingWorkers = os.cpu_count()  # Threads or processes reconstructing frames during export
+        self._processingMode = 'Threads'
         self.active = False
         self._RawQueue = Queue()
-        self._ProcQueue = Queue(maxsize=1)
+        self._ProcQueue = Mailbox()  # Latest image for display
+        self._framePoolSlots = 32
+        self._framePool = None
+        self._copyTimes = None  # perf_counter time each frame slot was filled, for the latency to display or export
+        self._frameNumbers = None  # Number of the frame in each slot since the start of a scan, counting those dropped
+        self.metrics = PipelineMetrics()
 
         # Qt
         self._widgets = []
@@ -117,6 +177,11 @@ class FigureEight:
         self.tabGrid.addWidget(self.groupQuantParams, 5, 3, 2, 1)
         self._widgets.append(self.groupQuantParams)
 
+        # Stage timings, rates and queue depths
+        self.groupPerformance = Widgets.PerformanceGroupBox('Performance', self)
+        self.tabGrid.addWidget(self.groupPerformance, 5, 2, 2, 1)
+        self.plotBScan.setMetrics(self.metrics)
+
         # Progress bar
         self.progress = Widgets.ProgressWidget(self)
         self.tabGrid.addWidget(self.progress, 3, 0, 1, 2)
@@ -128,18 +193,35 @@ class FigureEight:
 
         # ------------------------------------------------------------------------------------------------------------------
 
+        self.signals = ControllerSignals()
+        for widget in self._widgets:
+            self.signals.widgetsEnabled.connect(widget.enabled)
+
         # Setup
 
         self.start()
 
     def start(self):
-        init = threading.Thread(target=self.initializeSpectralRadar())
-        init.start()
-        init.join()
+        # The device is initialized in the background so the window draws and responds straight away. The processing
+        # kernels are loaded or compiled alongside it
+        self.setWidgetsEnabled(False)
+        self._warmUpThread = threading.Thread(target=self.warmUpProcessing, daemon=True)
+        self._warmUpThread.start()
+        self._initThread = threading.Thread(target=self.initializeSpectralRadar, daemon=True)
+        self._initThread.start()
+
+    def warmUpProcessing(self):
+        seconds = warmUp(workers=self._fftWorkers)
+        print('Processing kernels ready in ' + str(seconds)[0:5] + ' s')
+
+    def setWidgetsEnabled(self, bool):
+        """
+        Enables or disables the controls. Safe to call from any thread
+        """
+        self.signals.widgetsEnabled.emit(bool)
 
     def initializeSpectralRadar(self):  # TODO Implement on/off switch or splash while loading
-        for widget in self._widgets:
-            widget.enabled(False)
+        self.setWidgetsEnabled(False)
         self.progress.setText('Init device')
         self._device = PySpectralRadar.initDevice()
         self.progress.setProgress(2)
@@ -148,7 +230,8 @@ class FigureEight:
         self.progress.setProgress(4)
         self._proc = PySpectralRadar.createProcessingForDevice(self._device)
         self.progress.setText('Init camera')
-        PySpectralRadar.setCameraPreset(self._device, self._probe, self._proc, 0)  # 0 is the main camera
+        # The rate selected, which a re-init after setConfig keeps, so that the preset matches the calibration loaded
+        PySpectralRadar.setCameraPreset(self._device, self._probe, self._proc, self._rateEnum)
         self._triggerType = PySpectralRadar.Device_TriggerType.Trigger_FreeRunning  # Default
         self._triggerTimeout = 5  # Number from old labVIEW program
         self.progress.setProgress(6)
@@ -158,19 +241,15 @@ class FigureEight:
         self.updateScanPattern()
         self.progress.setProgress(7)
         self.progress.setText('Loading chirp')
-        try:
-            self._lam = np.load('lam.npy')
-        except FileNotFoundError:
-            self.progress.setText('Chirp not found')
-            self._lam = np.empty(2048)
-            for y in np.arange(2048):
-                self._lam[y] = PySpectralRadar.getWavelengthAtPixel(self._device, y)
-            np.save('lam', self._lam)
+        self._deviceIdentity = self.getDeviceIdentity()
+        self.loadCalibration()
+        if self._warmUpThread is not None and self._warmUpThread.is_alive():
+            self.progress.setText('Compiling processing kernels')
+            self._warmUpThread.join()  # Parallel kernels can't be launched from two threads at once
         self.progress.setProgress(10)
         self.progress.setText('Done!')
         print('Telesto initialized successfully.')
-        for widget in self._widgets:
-            widget.enabled(True)
+        self.setWidgetsEnabled(True)
         self.progress.setProgress(0)
         self.progress.setText('Ready')
 
@@ -181,10 +260,15 @@ class FigureEight:
             "2X": "LSM02-LV"
         }
 
-        self.closeSpectralRadar()
         self._config = configLUT[config]
-        self.initializeSpectralRadar()
+        self.setWidgetsEnabled(False)
+        self._initThread = threading.Thread(target=self.reinitializeSpectralRadar, daemon=True)
+        self._initThread.start()
 
+    def reinitializeSpectralRadar(self):
+        self.progress.setText('Closing device')
+        self.closeSpectralRadar()
+        self.initializeSpectralRadar()
         print('config changed')
 
     def setRate(self, rate):
@@ -198,13 +282,24 @@ class FigureEight:
 
         self.groupScanParams.update()
 
+        # The chirp may have to be read from the device, which takes too long for the GUI thread
+        self.setWidgetsEnabled(False)
+        self._initThread = threading.Thread(target=self.changeCameraPreset, daemon=True)
+        self._initThread.start()
+
+    def changeCameraPreset(self):
+        self.progress.setText('Changing camera preset')
         PySpectralRadar.setCameraPreset(self._device, self._probe, self._proc, self._rateEnum)
+        self.loadCalibration()
+        self.setWidgetsEnabled(True)
+        self.progress.setText('Ready')
 
     def getRateValue(self):
         return self._rateValue
 
     def closeSpectralRadar(self):
-        PySpectralRadar.clearScanPattern(self._scanPattern)
+        self._scanPatterns.clear()  # Handles belong to the probe
+        self._scanPattern = None
         PySpectralRadar.closeProcessing(self._proc)
         PySpectralRadar.closeProbe(self._probe)
         PySpectralRadar.closeDevice(self._device)
@@ -234,10 +329,14 @@ class FigureEight:
         return self._ProcQueue
 
     def setDisplayAxis(self, axis):
+        """
+        :param axis: Index of the B-scan to display, or None to display both
+        """
         self._displayAxis = axis
 
     def setApodWindow(self, window):
         self._apodWindow = window
+        self._backgroundWindow = None
 
     def getApodWindow(self):
         return self._apodWindow
@@ -245,6 +344,95 @@ class FigureEight:
     def getLambda(self):
         return self._lam
 
+    def getDeviceIdentity(self):
+        """
+        :return: Serial number of the device, which calibrations are stored by. 'default' if the SDK doesn't report one
+        """
+        try:
+            serial = PySpectralRadar.getDevicePropertyString(self._device,
+                                                             PySpectralRadar.DevicePropertyString.Device_SerialNumber)
+        except Exception:  # Not wrapped by every PySpectralRadar version, or not reported by the device
+            return 'default'
+        if isinstance(serial, bytes):
+            serial = serial.decode(errors='replace')
+        return serial.strip() or 'default'
+
+    def loadCalibration(self):
+        """
+        Loads the chirp and resampling tables for the device, probe and camera preset from the calibration store. A
+        saved chirp is only used if it matches the device at a few pixels, i.e. not after the device is recalibrated. On
+        a miss the chirp is read from the device and the entry saved for the next time
+        """
+        key = (self._deviceIdentity, self._config, self._rateEnum)
+        pixels = np.linspace(0, 2047, 5).astype(int)
+        reference = (pixels, [PySpectralRadar.getWavelengthAtPixel(self._device, y) for y in pixels])
+        calibration = self._calibration.load(*key, reference=reference)
+        if calibration is None:
+            self.progress.setText('Reading chirp from device')
+            lam = np.empty(2048)
+            for y in np.arange(2048):
+                lam[y] = PySpectralRadar.getWavelengthAtPixel(self._device, y)
+            calibration = (lam, generateInterpolationTables(lam))
+            try:
+                self._calibration.save(*key, *calibration)
+            except OSError as e:
+                print('Calibration not saved: ' + str(e))
+        self._lam, self._interpTables = calibration
+
+    def setBackgroundMode(self, mode):
+        self._backgroundMode = mode
+        self._backgroundWindow = None
+
+    def captureBackground(self):
+        # The next frames processed are averaged into a new reference background
+        self._referenceBackground = np.zeros([1, 2048])
+        self._referenceCount = 0
+
+    def getBackgroundWindow(self, A, B, parallel=True):
+        """
+        Returns the apodization window divided by the background spectrum for a raw frame. Per-frame mode uses the mean
+        of each B-scan in the frame. Reference mode averages the first frames after a capture into a fixed background
+        which is reused for the rest of the session. Rolling average mode keeps an exponential moving average
+        :param A: Raw uint16 OCT spectral data viewed as [N, 2048] A-scans
+        :param B: Index map of the A-scans in each B-scan, [b, n]
+        :param parallel: If False, the single-threaded kernel is used. Default is True
+        :return: Window, [b, 2048] or [1, 2048]
+        """
+        update = updateBackground8 if parallel else updateBackground8Serial
+
+        if self._backgroundMode == 'Per-frame':
+            return self.getApodWindow() / update(A, B, 1.0, np.empty([B.shape[0], 2048]))
+
+        if self._backgroundMode == 'Reference':
+            if self._referenceBackground is None:
+                self.captureBackground()
+            if self._referenceCount < self._referenceFrames:
+                self._referenceCount += 1
+                update(A, B, 1 / self._referenceCount, self._referenceBackground)  # Running mean
+                self._backgroundWindow = None
+            background = self._referenceBackground
+        else:
+            if self._rollingBackground is None:
+                self._rollingBackground = update(A, B, 1.0, np.empty([1, 2048]))
+            else:
+                update(A, B, self._rollingAlpha, self._rollingBackground)
+            self._backgroundWindow = None
+            background = self._rollingBackground
+
+        if self._backgroundWindow is None:
+            self._backgroundWindow = self.getApodWindow() / background
+
+        return self._backgroundWindow
+
+    def setFFTWorkers(self, workers):
+        self._fftWorkers = workers
+
+    def setProcessingWorkers(self, workers):
+        self._processingWorkers = workers
+
+    def setProcessingMode(self, mode):
+        self._processingMode = mode
+
     def setROI(self, axial):
         self._roi_z = axial
 
@@ -252,15 +440,22 @@ class FigureEight:
         print('Init scan')
 
         self.active = True
+        self._scanStartTime = time.perf_counter()
 
+        self.groupScanParams.flush()  # Apply an edit still waiting on the debounce
         self.updateScanPattern()
+        self._framePool = FramePool(self._framePoolSlots)
+        self.startMetrics('scan')
+        self.resetMotion()
+        self.flow.reset()
 
-        for widget in self._widgets:
-            widget.enabled(False)
+        self.setWidgetsEnabled(False)
 
         scan = threading.Thread(target=self.scan)
+        proc = threading.Thread(target=self.processScan)
         disp = threading.Thread(target=self.display)
         self._threads.append(scan)
+        self._threads.append(proc)
         self._threads.append(disp)
 
         for thread in self._threads:
@@ -272,85 +467,234 @@ class FigureEight:
 
         self.active = True
 
+        self.groupScanParams.flush()  # Apply an edit still waiting on the debounce
         self.updateScanPattern()
+        if self._processingMode == 'Processes' and self._fileType != 'Raw spectra':
+            self._framePool = SharedFramePool(self._framePoolSlots, [self.scanPatternN, 2048])
+        else:
+            self._framePool = FramePool(self._framePoolSlots)
+        self.startMetrics('acquire')
+        self.resetMotion()
+        self.flow.reset()
 
-        for widget in self._widgets:
-            widget.enabled(False)
+        self.setWidgetsEnabled(False)
 
-        acq = threading.Thread(target=self.acquire)
-        exp = threading.Thread(target=self.export_npy)
-        self._threads.append(acq)
-        self._threads.append(exp)
+        if self._fileType == 'Raw spectra':
+            # No processing during capture, frames go straight to disk
+            self._threads.append(threading.Thread(target=self.acquireRaw))
+        else:
+            acq = threading.Thread(target=self.acquire)
+            self._acquireThread = acq
+            if self._fileType == '.hdf':
+                exp = threading.Thread(target=self.export_hdf)
+            else:
+                exp = threading.Thread(target=self.export_npy)
+            self._threads.append(acq)
+            self._threads.append(exp)
 
         for thread in self._threads:
             thread.start()
 
-    @numba.jit(forceobj=True)
-    def process8(self, A, B1, ROI, B2=np.zeros(1)):
-
-        Nx = self._scanPatternAlinesPerCross
-        N = self.scanPatternN
-        interpIndices = np.linspace(min(self._lam), max(self._lam), 2048)
-
-        if B2.any() != 0:
-
-            processed = np.empty([1024, Nx, 2], dtype=np.complex64)
-            Bs = [B1, B2]
-
-            for b, B in enumerate(Bs):
-
-                interpolated = np.empty([2048, Nx])
-                preprocessed = preprocess8(A, N, B, Nx, self.getApodWindow())
-
-                for n in np.arange(Nx):
-                    k = interp1d(self._lam, preprocessed[:, n])
-                    interpolated[:, n] = k(interpIndices)
-                    processed[:, n, b] = np.fft.ifft(interpolated[:, n])[0:1024].astype(np.complex64)
-
+    def startMetrics(self, session):
+        # Timings and counters start over with each scan or acquisition
+        pool = self._framePool
+        self._copyTimes = [0.0] * self._framePoolSlots
+        self._frameNumbers = [0] * self._framePoolSlots
+        self.metrics.startSession(session, info={
+            'rate': self._rateValue,
+            'scanPatternN': self.scanPatternN,
+            'alinesPerCross': self._scanPatternAlinesPerCross,
+            'roi': self._roi_z,
+            'displayAxis': self._displayAxis,
+            'backgroundMode': self._backgroundMode,
+            'fileType': self._fileType if session == 'acquire' else None,
+            'processingMode': self._processingMode,
+            'processingWorkers': self._processingWorkers,
+            'fftWorkers': self._fftWorkers
+        })
+        self.metrics.watch('free slots', pool.getFree)
+        self.metrics.watch('raw queue', lambda: self.getRawQueue().qsize())
+
+    def setMotionEnabled(self, bool):
+        self._motionEnabled = bool
+        self.resetMotion()
+
+    def setRefractiveIndex(self, n):
+        self._refractiveIndex = n
+        self.resetMotion()
+
+    def resetMotion(self):
+        # Displacements are scaled by the chirp and A-line spacing in use
+        if self._lam is not None and self.scanPatternD is not None:
+            self.motion.configure(self._lam, self.scanPatternD, n=self._refractiveIndex)
         else:
-
-            processed = np.zeros([1024, Nx], dtype=np.complex64)
-
-            interpolated = np.empty([2048, Nx])
-            preprocessed = preprocess8(A, N, B1, Nx, self.getApodWindow())
-
-            for n in np.arange(Nx):
-                k = interp1d(self._lam, preprocessed[:, n])
-                interpolated[:, n] = k(interpIndices)
-                processed[:, n] = np.fft.ifft(interpolated[:, n])[0:1024].astype(np.complex64)
-
-        return processed[ROI[0]:ROI[1], :]
+            self.motion.reset()
+
+    def quantifyMotion(self, bscan, timestamp, axes=None, frame=None):
+        """
+        Tracks the displacement since the previous frame if motion quantification is enabled
+        :param bscan: Complex B-scans, [z, n, b], or [z, n] for a single B-scan
+        :param timestamp: perf_counter time the frame was copied off the camera
+        :param axes: Index of each B-scan in the figure-8. Default is both
+        :param frame: Number of the frame since the start, counting those dropped. See MotionTracker.update
+        """
+        if self._motionEnabled:
+            t = time.perf_counter()
+            self.motion.update(bscan, timestamp, axes=axes, frame=frame)
+            self.metrics.record('motion', t)
+
+    def setFlowMode(self, mode):
+        """
+        :param mode: 'Off', 'Speckle variance' or 'Phase variance'. Either of the latter displays that contrast and
+                     exports both with an acquisition
+        """
+        self._flowMode = mode
+
+    def setFlowWindow(self, window):
+        self.flow.reset(window=window)
+
+    def updateFlow(self, bscan, parallel=True, frame=None):
+        """
+        Adds a frame to the flow contrast statistics if flow contrast is enabled, and streams them to the flow writers
+        of an acquisition once the window is full
+        :param frame: Number of the frame since the start, counting those dropped. See FlowContrast.update
+        :return: The contrast selected for display, [z, n, b], or None
+        """
+        if self._flowMode == 'Off':
+            return None
+        t = time.perf_counter()
+        ready = self.flow.update(bscan, parallel=parallel, frame=frame)
+        if ready and self._flowWriters is not None:
+            self._flowWriters[0].append(self.flow.getIntensityVariance())
+            self._flowWriters[1].append(self.flow.getPhaseVariance())
+        if self._flowMode == 'Speckle variance':
+            contrast = self.flow.getSpeckleVariance()
+        else:
+            contrast = self.flow.getPhaseVariance()
+        self.metrics.record('flow', t)
+        return contrast
+
+    def openFlowWriters(self, root):
+        # The intensity and phase variance of each window are streamed next to the B-scans
+        self._flowWriters = None
+        if self._flowMode == 'Off':
+            return
+        repeats = self._scanPatternTotalRepeats - self.flow.getWindow()  # The first frame only references the phase
+        if repeats < 1:
+            print('Flow contrast not exported, the window is longer than the acquisition')
+            return
+        shape = [self._roi_z[1] - self._roi_z[0], self._scanPatternAlinesPerCross, 2]
+        self._flowWriters = [NpyWriter(root + '_intensityvar.npy', shape, repeats, dtype=np.float32),
+                             NpyWriter(root + '_phasevar.npy', shape, repeats, dtype=np.float32)]
+
+    def closeFlowWriters(self):
+        if self._flowWriters is not None:
+            for writer in self._flowWriters:
+                writer.close()
+            self._flowWriters = None
+
+    def process8(self, A, B, ROI):
+
+        start = time.perf_counter()
+        window = self.getBackgroundWindow(A.reshape(-1, 2048), np.atleast_2d(B))
+        self.metrics.record('background', start)
+
+        return reconstruct8(A, B, window, self._interpTables, ROI, workers=self._fftWorkers, metrics=self.metrics)
+
+    def processScan(self):
+        """
+        Reconstructs the frames of a scan and hands the latest image to the display. While motion or flow contrast is
+        tracked, every frame is reconstructed in order so that neither misses any, and frames are only dropped when the
+        processing falls behind far enough for the frame pool to run out. Otherwise the frames waiting are skipped for
+        the latest. The only thread of a scan launching parallel kernels
+        """
+        rawQueue = self.getRawQueue()
+        displayQueue = self.getProcessingQueue()
+        pool = self._framePool
+        metrics = self.metrics
+        copyTimes = self._copyTimes
+        frameNumbers = self._frameNumbers
+
+        while self.active:
+            if self._displayAxis is None:
+                B = self.scanPatternIdx  # Both B-scans are reconstructed together
+                axes = None
+            else:
+                B = self.scanPatternIdx[self._displayAxis]
+                axes = [self._displayAxis]
+            try:
+                t = time.perf_counter()
+                slot = rawQueue.get(timeout=1)
+                metrics.record('queue wait', t)
+            except Empty:
+                continue
+            if not self._motionEnabled and self._flowMode == 'Off':
+                while True:
+                    try:
+                        latest = rawQueue.get_nowait()
+                    except Empty:
+                        break
+                    pool.drop(slot)
+                    metrics.count('dropped')
+                    slot = latest
+            copied = copyTimes[slot]
+            frame = frameNumbers[slot]
+            raw = pool.frame(slot)
+            spec = raw.reshape(-1)[0:2048].copy()  # First spectrum of the B-scan only is plotted
+
+            bscan = self.process8(raw, B, ROI=self._roi_z)
+            pool.release(slot)
+            self.quantifyMotion(bscan, copied, axes=axes, frame=frame)
+            contrast = self.updateFlow(bscan, frame=frame)
+            if contrast is not None:
+                image = np.concatenate([contrast[:, :, 1], contrast[:, :, 0]], axis=1) if bscan.ndim == 3 \
+                    else contrast[:, :, 0]
+                levels = self._flowLevels[self._flowMode]
+            else:
+                image = np.concatenate([bscan[:, :, 1], bscan[:, :, 0]], axis=1) if bscan.ndim == 3 else bscan
+                levels = None  # dB of the complex B-scan
+            displayQueue.put((image, levels, spec, copied))  # Never blocks, replaces an image not yet displayed
 
     def display(self):
 
         running = True
-        processingQueue = self.getProcessingQueue()
-        Bs = [self.scanPatternB1, self.scanPatternB2]
+        displayQueue = self.getProcessingQueue()
+        metrics = self.metrics
 
         while running and self.active:
-            B = Bs[self._displayAxis]
             try:
-                raw = processingQueue.get()
-                spec = raw.flatten()[0:2048]  # First spectrum of the B-scan only is plotted
-
-                bscan = self.process8(raw, B, ROI=self._roi_z)
-
+                image, levels, spec, copied = displayQueue.get(timeout=1)
+                if levels is not None:
+                    self.plotBScan.updateScalar(image, levels)
+                else:
+                    self.plotBScan.update(image)  # X and Y side by side
+                t = time.perf_counter()
                 self.plotSpectrum.plot1D(spec)
-                self.plotBScan.update(20 * np.log10(np.abs(np.transpose(bscan))))
                 QtGui.QGuiApplication.processEvents()
+                t = metrics.record('redraw', t)
+                metrics.add('latency', t - copied)
+                metrics.count('displayed')
+
+                if self._scanStartTime is not None:
+                    print('First B-scan displayed ' + str(1000 * (time.perf_counter() - self._scanStartTime))[0:6] +
+                          ' ms after SCAN')
+                    self._scanStartTime = None
 
-            except Full:
+            except Empty:
                 pass
 
     def scan(self):
 
         self.progress.setText('Scanning...')
         running = True
-        processingQueue = self.getProcessingQueue()
-        counter = 0
-
-        # Set number of frames to process based on predicted speed
-        interval = [10, 10][self._rateEnum]
+        rawQueue = self.getRawQueue()
+        displayQueue = self.getProcessingQueue()
+        pool = self._framePool
+        metrics = self.metrics
+        copyTimes = self._copyTimes
+        frameNumbers = self._frameNumbers
+        frame = 0
+        catchingUp = False
 
         rawDataHandle = PySpectralRadar.createRawData()
 
@@ -360,35 +704,57 @@ class FigureEight:
 
         while running and self.active:
 
+            t = time.perf_counter()
+
             self.getRawData(rawDataHandle)
 
+            t = metrics.record('getRawData', t)
+
             dim = PySpectralRadar.getRawDataShape(rawDataHandle)
 
-            temp = np.empty(dim, dtype=np.uint16)
+            if np.prod(dim) > 0:
 
-            PySpectralRadar.copyRawDataContent(rawDataHandle, temp)
+                pool.allocate(dim)
 
-            if np.size(temp) > 0:
+                slot = pool.borrow(block=False)  # Live display drops frames rather than stall the camera
 
-                if counter % interval == 0:
+                # Once the pool has run out, frames are dropped until the processing has caught up with those queued,
+                # so that motion and flow get runs of successive frames rather than a gap after every other one
+                if catchingUp and rawQueue.empty():
+                    catchingUp = False
+                if slot is not None and catchingUp:
+                    pool.drop(slot)
+                    slot = None
 
-                    new = deepcopy(temp)
+                if slot is not None:
 
-                    try:
+                    PySpectralRadar.copyRawDataContent(rawDataHandle, pool.frame(slot))
+
+                    copyTimes[slot] = metrics.record('copy', t)
+                    frameNumbers[slot] = frame
+                    metrics.count('acquired')
 
-                        processingQueue.put(new)
+                    rawQueue.put(slot)  # In order, processScan decides which frames to skip
 
-                    except Full:
+                else:
 
-                        pass
+                    catchingUp = True
+                    metrics.count('dropped')
 
-            counter += 1
+                frame += 1
 
         PySpectralRadar.clearRawData(rawDataHandle)
 
+        print('Scan frames: ' + str(pool.getStats()) + ', overwritten before display: ' +
+              str(displayQueue.getOverwritten()))
+
     def acquire(self):
 
         rawQueue = self.getRawQueue()
+        pool = self._framePool
+        metrics = self.metrics
+        copyTimes = self._copyTimes
+        frameNumbers = self._frameNumbers
 
         rawDataHandle = PySpectralRadar.createRawData()
 
@@ -398,35 +764,164 @@ class FigureEight:
 
         for i in np.arange(self._scanPatternTotalRepeats):
 
+            if not self.active:
+                break
+
+            t = time.perf_counter()
+
             self.getRawData(rawDataHandle)
 
+            t = metrics.record('getRawData', t)
+
             dim = PySpectralRadar.getRawDataShape(rawDataHandle)
 
-            temp = np.empty(dim, dtype=np.uint16)
+            if np.prod(dim) == 0:
 
-            PySpectralRadar.copyRawDataContent(rawDataHandle, temp)
+                metrics.count('dropped')
 
-            new = deepcopy(temp)
+                continue
 
-            try:
+            pool.allocate(dim)
 
-                rawQueue.put(new)
+            slot = pool.borrow(timeout=self._triggerTimeout)  # Waits for the export to catch up
 
-            except Full:
+            if slot is None:
 
-                pass
+                metrics.count('dropped')
+
+                continue
+
+            t = metrics.record('free slot wait', t)
 
-        self.stopMeasurement()
+            PySpectralRadar.copyRawDataContent(rawDataHandle, pool.frame(slot))
+
+            copyTimes[slot] = metrics.record('copy', t)
+            frameNumbers[slot] = i
+            metrics.count('acquired')
+
+            rawQueue.put(slot)
+
+        rawQueue.put(None)  # Tells the export no more frames are coming, including any dropped
+
+        if self.active:
+            self.stopMeasurement()
 
         PySpectralRadar.clearRawData(rawDataHandle)
 
         print('Acquisition complete')
+        print('Acquisition frames: ' + str(pool.getStats()))
 
-    def export_hdf(self):  # TODO fix this
+    def acquireRaw(self):
 
-        pass
+        self.progress.setText('Acquiring raw spectra...')
 
-    def export_npy(self):
+        try:
+            os.mkdir(self._fileExperimentDirectory)
+        except FileExistsError:
+            pass
+        root = self.getFilepath()
+        self.exportScanParams(root + '_params.npz')
+        writer = None
+        error = None
+        pool = self._framePool
+        metrics = self.metrics
+        copyTimes = self._copyTimes
+
+        def written(slot):
+            metrics.add('latency', time.perf_counter() - copyTimes[slot])
+            metrics.count('exported')
+            pool.release(slot)
+
+        rawDataHandle = PySpectralRadar.createRawData()
+
+        self.getRawData(rawDataHandle)
+
+        self.startMeasurement()
+
+        for i in np.arange(self._scanPatternTotalRepeats):
+
+            if not self.active:
+                break
+
+            if writer is not None and writer.getError() is not None:
+                break  # The frames queued behind a failed write never return their slots
+
+            t = time.perf_counter()
+
+            self.getRawData(rawDataHandle)
+
+            t = metrics.record('getRawData', t)
+
+            dim = PySpectralRadar.getRawDataShape(rawDataHandle)
+
+            if np.prod(dim) == 0:
+                metrics.count('dropped')
+                continue
+
+            pool.allocate(dim)
+
+            slot = pool.borrow(timeout=self._triggerTimeout)  # Waits for the disk to catch up
+
+            if slot is None:
+                metrics.count('dropped')
+                continue
+
+            t = metrics.record('free slot wait', t)
+
+            PySpectralRadar.copyRawDataContent(rawDataHandle, pool.frame(slot))
+
+            copyTimes[slot] = t = metrics.record('copy', t)
+            metrics.count('acquired')
+
+            try:
+                if writer is None:
+                    writer = RawWriter(root + '_raw.npy', dim, self._scanPatternTotalRepeats)
+                    metrics.watch('write backlog', writer.getBacklog)
+
+                writer.append(pool.frame(slot), done=lambda slot=slot: written(slot))
+            except Exception as e:
+                error = e
+                pool.release(slot)
+                break
+            metrics.record('write', t)  # Only waits when the disk falls behind
+
+        if self.active:
+            self.stopMeasurement()
+
+        PySpectralRadar.clearRawData(rawDataHandle)
+
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                error = e
+        print('Acquisition frames: ' + str(pool.getStats()))
+        if error is not None:
+            print('Saving raw .npy failed after ' + str(0 if writer is None else writer.getCount()) + ' frames: ' +
+                  str(error))
+            self.exportComplete()
+            self.progress.setText('Saving failed: ' + str(error))
+        else:
+            self.progress.setText('Acquisition complete!')
+            print('Saving raw .npy complete')
+            self.exportComplete()
+
+    def exportScanParams(self, path):
+        # Everything needed to reconstruct raw spectra offline
+        np.savez(path,
+                 lam=self._lam,
+                 apod=self.getApodWindow(),
+                 roi=self._roi_z,
+                 rate=self._rateValue,
+                 scanPatternX=self.scanPatternX,
+                 scanPatternY=self.scanPatternY,
+                 scanPatternB1=self.scanPatternB1,
+                 scanPatternB2=self.scanPatternB2,
+                 scanPatternN=self.scanPatternN,
+                 scanPatternD=self.scanPatternD,
+                 scanPatternIdx=self.scanPatternIdx)
+
+    def export_hdf(self):
 
         self.progress.setText('Processing...')
 
@@ -435,21 +930,169 @@ class FigureEight:
             os.mkdir(self._fileExperimentDirectory)
         except FileExistsError:
             pass
-        root = self.getFilepath() + '.npy'
-        out = np.empty([self._roi_z[1]-self._roi_z[0], self._scanPatternAlinesPerCross, 2, self._scanPatternTotalRepeats],
-                       dtype=np.complex64)  # TODO: implement max file size
+        root = self.getFilepath() + '.hdf'
+        attrs = {
+            'scanPatternX': self.scanPatternX,
+            'scanPatternY': self.scanPatternY,
+            'scanPatternB1': self.scanPatternB1,
+            'scanPatternB2': self.scanPatternB2,
+            'scanPatternN': self.scanPatternN,
+            'scanPatternD': self.scanPatternD,
+            'roi': self._roi_z,
+            'rate': self._rateValue
+        }
+        writer = HDFWriter(root,
+                           [self._roi_z[1] - self._roi_z[0], self._scanPatternAlinesPerCross, 2],
+                           chunks=self._hdfChunks,
+                           compression=self._hdfCompression,
+                           compressionOpts=self._hdfCompressionOpts,
+                           attrs=attrs)
+
+        self.openFlowWriters(self.getFilepath())
+        self.exportFrames(q, writer)
+
+        writer.close()
+        self.closeFlowWriters()
+        self.progress.setText('Export complete!')
+        print('Saving .hdf complete')
+        self.exportComplete()
 
-        for i in np.arange(self._scanPatternTotalRepeats):
-            temp = q.get()
+    def export_npy(self):
 
-            bscan = self.process8(temp, self.scanPatternB1, ROI=self._roi_z, B2=self.scanPatternB2)
+        self.progress.setText('Processing...')
 
-            out[:, :, :, i] = bscan
+        q = self.getRawQueue()
+        try:
+            os.mkdir(self._fileExperimentDirectory)
+        except FileExistsError:
+            pass
+        root = self.getFilepath() + '.npy'
+        writer = NpyWriter(root,
+                           [self._roi_z[1] - self._roi_z[0], self._scanPatternAlinesPerCross, 2],
+                           self._scanPatternTotalRepeats)  # TODO: implement max file size
+
+        self.openFlowWriters(self.getFilepath())
+        self.exportFrames(q, writer)
 
+        writer.close()
+        self.closeFlowWriters()
         self.progress.setText('Export complete!')
-        np.save(root, out)
         print('Saving .npy complete')
+        self.exportComplete()
+
+    def exportFrames(self, q, writer):
+        """
+        Reconstructs the frames from the raw queue on a pool of worker threads and appends them to the writer in
+        acquisition order. The background is estimated here, in order, and the reconstruction itself runs on the
+        workers with single-threaded kernels so that they can run at the same time. Stops after the total number of
+        repeats, or after the frames acquired before a None on the raw queue if the acquisition dropped some
+        """
+        if isinstance(self._framePool, SharedFramePool):
+            return self.exportFramesMultiprocess(q, writer)
+
+        pool = self._framePool
+        idx = self.scanPatternIdx
+        roi = self._roi_z
+        total = self._scanPatternTotalRepeats
+        workers = OrderedWorkerPool(self._processingWorkers)
+        submitted = 0
+        metrics = self.metrics
+        copied = deque()  # Copy times and numbers of the frames submitted, in order
+
+        def process(slot, window):
+            try:
+                return reconstruct8(pool.frame(slot), idx, window, self._interpTables, roi, parallel=False,
+                                    metrics=metrics)
+            finally:
+                pool.release(slot)
+
+        metrics.watch('export pending', workers.__len__)
+
+        while writer.getCount() < total and self.active:
+            if submitted < total and not workers.full():
+                try:
+                    t = time.perf_counter()
+                    slot = q.get(timeout=0.01 if len(workers) > 0 else 1)
+                    t = metrics.record('queue wait', t)
+                    if slot is None:
+                        total = submitted  # Frames were dropped, the writer is trimmed to those acquired
+                        continue
+                    copied.append((self._copyTimes[slot], self._frameNumbers[slot]))
+                    window = self.getBackgroundWindow(pool.frame(slot).reshape(-1, 2048), idx, parallel=False)
+                    metrics.record('background', t)
+                    workers.submit(process, slot, window)
+                    submitted += 1
+                    continue
+                except Empty:
+                    if len(workers) == 0:
+                        continue
+            self.writeFrame(writer, workers.next(), *copied.popleft())
+
+        workers.close()
+
+    def writeFrame(self, writer, bscan, copied, frame, parallel=False):
+        """
+        Appends a reconstructed frame to the writer, timing the write and the latency from its copy off the camera, and
+        tracks its motion and flow contrast. Every frame acquired is written in order, so none are skipped by either,
+        and the frame number leaves out the steps across any the acquisition dropped
+        """
+        t = time.perf_counter()
+        writer.append(bscan)
+        t = self.metrics.record('write', t)
+        self.metrics.add('latency', t - copied)
+        self.metrics.count('exported')
+        self.quantifyMotion(bscan, copied, frame=frame)
+        self.updateFlow(bscan, parallel=parallel, frame=frame)
+
+    def exportFramesMultiprocess(self, q, writer):
+        """
+        Same as exportFrames, but the reconstruction runs in worker processes which read the raw frames from the
+        shared memory of the frame pool. Only slot descriptors cross the process boundary
+        """
+        pool = self._framePool
+        idx = self.scanPatternIdx
+        total = self._scanPatternTotalRepeats
+        pipeline = ProcessPipeline(pool, self._processingWorkers, idx, self._interpTables, self._roi_z)
+        submitted = 0
+        metrics = self.metrics
+        copied = deque()
+
+        metrics.watch('export pending', pipeline.getPending)
+
+        while writer.getCount() < total and self.active:
+            if submitted < total:
+                try:
+                    t = time.perf_counter()
+                    slot = q.get(timeout=0.01 if pipeline.getPending() > 0 else 1)
+                    t = metrics.record('queue wait', t)
+                    if slot is None:
+                        total = submitted  # Frames were dropped, the writer is trimmed to those acquired
+                        continue
+                    copied.append((self._copyTimes[slot], self._frameNumbers[slot]))
+                    window = self.getBackgroundWindow(pool.frame(slot).reshape(-1, 2048), idx)
+                    metrics.record('background', t)
+                    pipeline.submit(slot, window)
+                    submitted += 1
+                    continue
+                except Empty:
+                    if pipeline.getPending() == 0:
+                        continue
+            slot, bscan = pipeline.next()
+            metrics.add('reconstruct', pipeline.getLatency())  # In the worker processes, from submission
+            self.writeFrame(writer, bscan, *copied.popleft(), parallel=True)  # No worker threads to share cores with
+            pool.release(slot)
+
+        pipeline.close()
+        self._acquireThread.join()  # After an abort the acquisition may still be copying into the pool
+        pool.close()
+
+    def exportComplete(self):
         # This is just the abort method w/o call to stop measurement
+        self.metrics.sample()
+        try:
+            self.metrics.saveTrace(self.getFilepath() + '_perf.json')
+        except OSError as e:
+            print('Performance trace not saved: ' + str(e))
         self.progress.setText('Stopped')
         self.progress.setProgress(0)
         if self.active:
@@ -458,9 +1101,8 @@ class FigureEight:
                 thread._is_running = False
             self._threads = []
             self._RawQueue = Queue()
-            self._ProcQueue = Queue()
-            for widget in self._widgets:
-                widget.enabled(True)
+            self._ProcQueue = Mailbox()
+            self.setWidgetsEnabled(True)
 
     def abort(self):
         print('Abort')  # TODO different function for mid-acq abort vs end of acquisition. Also write a safer one
@@ -472,16 +1114,22 @@ class FigureEight:
                 thread._is_running = False
             self._threads = []
             self._RawQueue = Queue()
-            self._ProcQueue = Queue()
+            self._ProcQueue = Mailbox()
             self.stopMeasurement()
-            for widget in self._widgets:
-                widget.enabled(True)
+            self.setWidgetsEnabled(True)
 
     def close(self):
         print('Close')
+        if self._initThread is not None:
+            self._initThread.join()  # Don't close the device halfway through its initialization
         self.abort()
         self.closeSpectralRadar()
 
+    def setHDFParams(self, chunks=None, compression='lzf', compressionOpts=None):
+        self._hdfChunks = chunks
+        self._hdfCompression = compression
+        self._hdfCompressionOpts = compressionOpts
+
     def setFileParams(self, experimentDirectory, experimentName, maxSize, fileType):
         self._fileExperimentDirectory = experimentDirectory
         self._fileExperimentName = experimentName
@@ -492,7 +1140,8 @@ class FigureEight:
         return self._fileExperimentDirectory + '/' + self._fileExperimentName
 
     def clearScanPattern(self):
-        PySpectralRadar.clearScanPattern(self._scanPattern)
+        self._scanPatterns.clear()
+        self._scanPattern = None
 
     def getScanPattern(self):
         return self._scanPattern
@@ -501,11 +1150,17 @@ class FigureEight:
         return self._scanPatternAlinesPerCross
 
     def updateScanPattern(self):
-        self._scanPattern = PySpectralRadar.createFreeformScanPattern(self._probe,
-                                                                      self.scanPatternPositions,
-                                                                      self.scanPatternN,
-                                                                      1,  # All repeating patterns handled with loops!
-                                                                      False)
+        # Handles are reused for patterns created before with the same probe. Evicted handles are cleared
+        key = (self._scanPatternKey, self._config)
+        scanPattern = self._scanPatterns.get(key)
+        if scanPattern is None:
+            scanPattern = PySpectralRadar.createFreeformScanPattern(self._probe,
+                                                                    self.scanPatternPositions,
+                                                                    self.scanPatternN,
+                                                                    1,  # All repeating patterns handled with loops!
+                                                                    False)
+            self._scanPatterns.put(key, scanPattern)
+        self._scanPattern = scanPattern
 
     def setScanPatternParams(self, patternSize, aLinesPerCross, bPadding, aLinesPerFlyback, repeats, patternAngle, flybackAngle):
         self._scanPatternSize = patternSize
@@ -516,19 +1171,26 @@ class FigureEight:
         self._scanPatternAngle = patternAngle
         self._scanPatternFlybackAngle = flybackAngle
 
+        self._scanPatternKey = (patternSize, aLinesPerCross, bPadding, aLinesPerFlyback, patternAngle, flybackAngle)
+        geometry = self._patternGeometry.get(self._scanPatternKey)
+        if geometry is None:
+            geometry = generateIdealFigureEightPositions(patternSize,
+                                                         aLinesPerCross,
+                                                         padB=bPadding,
+                                                         rpt=1,  # All repeating patterns handled with loops!
+                                                         angle=patternAngle,
+                                                         flyback=aLinesPerFlyback,
+                                                         flybackAngle=flybackAngle)
+            self._patternGeometry.put(self._scanPatternKey, geometry)
+
         [self.scanPatternPositions,
          self.scanPatternX,
          self.scanPatternY,
          self.scanPatternB1,
          self.scanPatternB2,
          self.scanPatternN,
-         self.scanPatternD] = generateIdealFigureEightPositions(patternSize,
-                                                                aLinesPerCross,
-                                                                padB=bPadding,
-                                                                rpt=1,  # All repeating patterns handled with loops!
-                                                                angle=patternAngle,
-                                                                flyback=aLinesPerFlyback,
-                                                                flybackAngle=flybackAngle)
+         self.scanPatternD,
+         self.scanPatternIdx] = geometry
 
     def displayPattern(self):
         self.plotPattern.plotFigEight(self.scanPatternX[np.invert(self.scanPatternB1 + self.scanPatternB2)],
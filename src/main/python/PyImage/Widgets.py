@@ -10,11 +10,14 @@ from PyQt5.QtWidgets import QFormLayout
 from PyQt5.QtWidgets import QTextEdit
 from PyQt5.QtWidgets import QWidget
 from PyQt5.QtWidgets import QRadioButton
+from PyQt5.QtWidgets import QCheckBox
 from PyQt5.QtWidgets import QHBoxLayout
 from PyQt5.QtWidgets import QProgressBar
+from PyQt5.QtWidgets import QTableWidget
+from PyQt5.QtWidgets import QTableWidgetItem
+from PyQt5.QtWidgets import QFileDialog
 
 import pyqtgraph as PyQtG
-from pyqtgraph.Qt import QtGui
 from PyQt5 import QtCore
 
 import time
@@ -50,7 +53,7 @@ class FileGroupBox(QGroupBox):
         self.entryFileSize.currentIndexChanged.connect(self.update)
 
         self.entryFileType = QComboBox()
-        self.entryFileType.addItems([".npy", ".hdf"])
+        self.entryFileType.addItems([".npy", ".hdf", "Raw spectra"])
         self.entryFileType.currentIndexChanged.connect(self.update)
 
         self.layout.addRow(QLabel("Experiment name"), self.entryExpName)
@@ -97,14 +100,32 @@ class ParamsGroupBox(QGroupBox):
         self.entryWindow.addItems(["Hann", "Hamming", "Blackman", "None"])
         self.entryWindow.currentIndexChanged.connect(self.update)
 
+        self.entryBackground = QComboBox()
+        self.entryBackground.addItems(["Per-frame", "Reference", "Rolling average"])
+        self.entryBackground.currentIndexChanged.connect(lambda: self.controller.setBackgroundMode(str(self.entryBackground.currentText())))
+
+        self.captureButton = QPushButton('Capture')
+        self.captureButton.clicked.connect(self.controller.captureBackground)
+
+        self.backgroundBoxLayout = QHBoxLayout()
+        self.backgroundBoxLayout.addWidget(self.entryBackground)
+        self.backgroundBoxLayout.addWidget(self.captureButton)
+
+        self.entryProcessing = QComboBox()
+        self.entryProcessing.addItems(["Threads", "Processes"])
+        self.entryProcessing.currentIndexChanged.connect(lambda: self.controller.setProcessingMode(str(self.entryProcessing.currentText())))
+
         self.radioBoxB = QWidget(parent=self)
-        self.radioBoxB.setFixedWidth(80)
+        self.radioBoxB.setFixedWidth(150)
         self.radioBoxBLayout = QHBoxLayout()
         self.B1 = QRadioButton('Y')
         self.B2 = QRadioButton('X')
-        self.B2.setChecked(True)
+        self.B12 = QRadioButton('X+Y')
+        self.B12.setChecked(True)
         self.B1.toggled.connect(self.update)
         self.B2.toggled.connect(self.update)
+        self.B12.toggled.connect(self.update)
+        self.radioBoxBLayout.addWidget(self.B12)
         self.radioBoxBLayout.addWidget(self.B2)
         self.radioBoxBLayout.addWidget(self.B1)
         self.radioBoxB.setLayout(self.radioBoxBLayout)
@@ -112,6 +133,8 @@ class ParamsGroupBox(QGroupBox):
         self.layout.addRow(QLabel("Imaging rate"), self.entryImagingRate)
         self.layout.addRow(QLabel("Objective configuration"), self.entryConfig)
         self.layout.addRow(QLabel("Apodization window"), self.entryWindow)
+        self.layout.addRow(QLabel("Background"), self.backgroundBoxLayout)
+        self.layout.addRow(QLabel("Export processing"), self.entryProcessing)
         self.layout.addRow(QLabel("B-Scan display"), self.radioBoxB)
 
         self.setLayout(self.layout)
@@ -131,7 +154,9 @@ class ParamsGroupBox(QGroupBox):
 
         self.controller.setApodWindow(window)
 
-        if self.B1.isChecked():
+        if self.B12.isChecked():
+            self.controller.setDisplayAxis(None)
+        elif self.B1.isChecked():
             self.controller.setDisplayAxis(0)
         else:
             self.controller.setDisplayAxis(1)
@@ -142,6 +167,11 @@ class ParamsGroupBox(QGroupBox):
         self.entryImagingRate.setEnabled(bool)
         self.entryConfig.setEnabled(bool)
         self.entryWindow.setEnabled(bool)
+        # Changing the background mid-session would normalize its frames inconsistently. A capture made between
+        # sessions is averaged from the first frames of the next
+        self.entryBackground.setEnabled(bool)
+        self.captureButton.setEnabled(bool)
+        self.entryProcessing.setEnabled(bool)
         # self.B1.setEnabled(bool)  # For now, switching views works during scanning
         # self.B2.setEnabled(bool)
 
@@ -179,6 +209,11 @@ class ControlGroupBox(QGroupBox):
 
 class ProgressWidget(QWidget):
 
+    # setText and setProgress are called from the device and processing threads, so the label and bar are only
+    # updated through queued signals on the GUI thread
+    textChanged = QtCore.pyqtSignal(str)
+    progressChanged = QtCore.pyqtSignal(int)
+
     def __init__(self, controller):
         super().__init__()
 
@@ -186,7 +221,7 @@ class ProgressWidget(QWidget):
 
         self.layout = QHBoxLayout()
 
-        self.bar = QtGui.QProgressBar()
+        self.bar = QProgressBar()
         self.bar.setMinimum(0)
         self.bar.setMaximum(10)
         self.bar.setValue(0)
@@ -198,12 +233,14 @@ class ProgressWidget(QWidget):
 
         self.setLayout(self.layout)
 
+        self.textChanged.connect(self.label.setText)
+        self.progressChanged.connect(self.bar.setValue)
+
     def setText(self,s):
-        self.label.setText(s)
+        self.textChanged.emit(s)
 
     def setProgress(self,v):
-        self.bar.setValue(v)
-        QtGui.QGuiApplication.processEvents()
+        self.progressChanged.emit(int(v))
 
 
 class Fig8GroupBox(QGroupBox):
@@ -213,27 +250,33 @@ class Fig8GroupBox(QGroupBox):
 
         self.controller = controller
 
+        # Spin box edits are applied once they stop for a moment instead of on every tick
+        self.updateTimer = QtCore.QTimer()
+        self.updateTimer.setSingleShot(True)
+        self.updateTimer.setInterval(150)  # ms
+        self.updateTimer.timeout.connect(self.update)
+
         self.layout = QFormLayout()
 
         self.spinALinesPerX = QSpinBox()
         self.spinALinesPerX.setRange(5, 400)
         self.spinALinesPerX.setValue(100)
-        self.spinALinesPerX.valueChanged.connect(self.update)
+        self.spinALinesPerX.valueChanged.connect(self.scheduleUpdate)
 
         self.spinBPadding = QSpinBox()
         self.spinBPadding.setValue(20)
-        self.spinBPadding.valueChanged.connect(self.update)
+        self.spinBPadding.valueChanged.connect(self.scheduleUpdate)
 
         self.spinFlyback = QSpinBox()
         self.spinFlyback.setRange(2, 600)
         self.spinFlyback.setValue(50)
-        self.spinFlyback.valueChanged.connect(self.update)
+        self.spinFlyback.valueChanged.connect(self.scheduleUpdate)
 
         self.spinAngle = QSpinBox()
         self.spinAngle.setRange(0, 360)
         self.spinAngle.setValue(43)
         self.spinAngle.setSuffix('°')
-        self.spinAngle.valueChanged.connect(self.update)
+        self.spinAngle.valueChanged.connect(self.scheduleUpdate)
 
         self.spinFlybackAngle = QDoubleSpinBox()
         self.spinFlybackAngle.setRange(40, 120)
@@ -241,7 +284,7 @@ class Fig8GroupBox(QGroupBox):
         self.spinFlybackAngle.setSingleStep(0.5)
         self.spinFlybackAngle.setDecimals(1)
         self.spinFlybackAngle.setSuffix('°')
-        self.spinFlybackAngle.valueChanged.connect(self.update)
+        self.spinFlybackAngle.valueChanged.connect(self.scheduleUpdate)
 
         self.spinALineSpacing = QDoubleSpinBox()
         self.spinALineSpacing.setRange(0.001, 2000)
@@ -249,17 +292,17 @@ class Fig8GroupBox(QGroupBox):
         self.spinALineSpacing.setDecimals(2)
         self.spinALineSpacing.setSingleStep(0.10)
         self.spinALineSpacing.setValue(3.00)
-        self.spinALineSpacing.valueChanged.connect(self.update)
+        self.spinALineSpacing.valueChanged.connect(self.scheduleUpdate)
 
         self.spinFig8Total = QSpinBox()
         self.spinFig8Total.setRange(2, 5000)
         self.spinFig8Total.setValue(500)
-        self.spinFig8Total.valueChanged.connect(self.update)
+        self.spinFig8Total.valueChanged.connect(self.scheduleUpdate)
 
         self.spinAcqTime = QSpinBox()
         self.spinAcqTime.setRange(10, 20000)
         self.spinAcqTime.setValue(1000)
-        self.spinAcqTime.valueChanged.connect(self.update)
+        self.spinAcqTime.valueChanged.connect(self.scheduleUpdate)
 
         self.textRate = QTextEdit()
         self.textRate.setReadOnly(True)
@@ -286,6 +329,14 @@ class Fig8GroupBox(QGroupBox):
 
         self.update()
 
+    def scheduleUpdate(self):
+        self.updateTimer.start()
+
+    def flush(self):
+        if self.updateTimer.isActive():
+            self.updateTimer.stop()
+            self.update()
+
     def update(self):
 
         self.spinBPadding.setRange(0,int((self.spinALinesPerX.value()-1)))
@@ -324,10 +375,12 @@ class QuantGroupBox(QGroupBox):
         self.layout = QFormLayout()
 
         self.spinAxialMin = QSpinBox()
+        self.spinAxialMin.setRange(0, 1023)
         self.spinAxialMin.setValue(8)
         self.spinAxialMin.valueChanged.connect(self.update)
 
         self.spinAxialMax = QSpinBox()
+        self.spinAxialMax.setRange(9, 1024)  # Otherwise the default is clamped to 99
         self.spinAxialMax.setValue(400)
         self.spinAxialMax.valueChanged.connect(self.update)
 
@@ -337,10 +390,63 @@ class QuantGroupBox(QGroupBox):
 
         self.layout.addRow(QLabel('Axial ROI top-bottom'), self.axialBoxLayout)
 
+        self.checkMotion = QCheckBox('Quantify motion')
+        self.checkMotion.toggled.connect(self.setMotionEnabled)
+
+        self.resetMotionButton = QPushButton('Reset')
+        self.resetMotionButton.clicked.connect(self.controller.resetMotion)
+
+        self.motionBoxLayout = QHBoxLayout()
+        self.motionBoxLayout.addWidget(self.checkMotion)
+        self.motionBoxLayout.addWidget(self.resetMotionButton)
+
+        self.spinRefractiveIndex = QDoubleSpinBox()
+        self.spinRefractiveIndex.setRange(1.0, 2.0)
+        self.spinRefractiveIndex.setDecimals(3)
+        self.spinRefractiveIndex.setSingleStep(0.01)
+        self.spinRefractiveIndex.setValue(1.38)
+        self.spinRefractiveIndex.valueChanged.connect(self.controller.setRefractiveIndex)
+
+        self.plotMotion = MotionPlotWidget('Displacement')
+        self.plotMotion.setMinimumHeight(150)
+
+        self.plotTimer = QtCore.QTimer()
+        self.plotTimer.setInterval(50)  # ms
+        self.plotTimer.timeout.connect(self.plotMotionTraces)
+
+        self.entryFlow = QComboBox()
+        self.entryFlow.addItems(['Off', 'Speckle variance', 'Phase variance'])
+        self.entryFlow.currentIndexChanged.connect(lambda: self.controller.setFlowMode(str(self.entryFlow.currentText())))
+
+        self.spinFlowWindow = QSpinBox()
+        self.spinFlowWindow.setRange(2, 64)
+        self.spinFlowWindow.setValue(8)
+        self.spinFlowWindow.valueChanged.connect(self.controller.setFlowWindow)
+
+        self.flowBoxLayout = QHBoxLayout()
+        self.flowBoxLayout.addWidget(self.entryFlow)
+        self.flowBoxLayout.addWidget(QLabel('Window'))
+        self.flowBoxLayout.addWidget(self.spinFlowWindow)
+
+        self.layout.addRow(self.motionBoxLayout)
+        self.layout.addRow(QLabel('Refractive index'), self.spinRefractiveIndex)
+        self.layout.addRow(self.plotMotion)
+        self.layout.addRow(QLabel('Flow contrast'), self.flowBoxLayout)
+
         self.setLayout(self.layout)
 
         self.update()
 
+    def setMotionEnabled(self, bool):
+        self.controller.setMotionEnabled(bool)
+        if bool:
+            self.plotTimer.start()
+        else:
+            self.plotTimer.stop()
+
+    def plotMotionTraces(self):
+        self.plotMotion.plotTraces(*self.controller.motion.getTraces())
+
     def update(self):
 
         self.spinAxialMax.setRange(self.spinAxialMin.value()+1, 1024)
@@ -350,7 +456,82 @@ class QuantGroupBox(QGroupBox):
         self.controller.setROI(axial)
 
     def enabled(self, bool):
-        # For now, ROI change during scan works fine.
+        # For now, ROI change during scan works fine. The flow window stays fixed while statistics are streamed
+        self.spinFlowWindow.setEnabled(bool)
+
+
+class PerformanceGroupBox(QGroupBox):
+    """
+    Live view of the controller's PipelineMetrics: rates of the frame counters, gauges such as queue depths, and the
+    recent duration of each stage. Sampled once a second, which also builds the trace of the session
+    """
+
+    STAGES = ['getRawData', 'free slot wait', 'copy', 'queue wait', 'background', 'preprocess', 'fft', 'reconstruct',
+              'motion', 'flow', 'log', 'render', 'redraw', 'write', 'latency']  # Pipeline order. Stages not listed follow them
+    COLUMNS = ['count', 'mean', 'p50', 'p95', 'p99', 'max']
+
+    def __init__(self, name, controller):
+        super().__init__(name)
+
+        self.controller = controller
+
+        self.layout = QGridLayout()
+
+        self.labelSummary = QLabel('')
+        self.labelSummary.setWordWrap(True)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels([self.COLUMNS[0]] + [column + ' ms' for column in self.COLUMNS[1:]])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.setMinimumHeight(150)
+
+        self.resetButton = QPushButton('Reset')
+        self.resetButton.clicked.connect(self.reset)
+        self.saveButton = QPushButton('Save trace')
+        self.saveButton.clicked.connect(self.save)
+
+        self.layout.addWidget(self.labelSummary, 0, 0, 1, 2)
+        self.layout.addWidget(self.table, 1, 0, 1, 2)
+        self.layout.addWidget(self.resetButton, 2, 0)
+        self.layout.addWidget(self.saveButton, 2, 1)
+
+        self.setLayout(self.layout)
+
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(1000)  # ms
+        self.timer.timeout.connect(self.update)
+        self.timer.start()
+
+    def update(self):
+        snapshot = self.controller.metrics.sample()
+
+        summary = [name + ' ' + str(value) + ' (' + str(round(snapshot['rates'][name], 1)) + '/s)'
+                   for name, value in snapshot['counters'].items()]
+        summary += [name + ' ' + str(value) for name, value in snapshot['gauges'].items()]
+        self.labelSummary.setText(', '.join(summary))
+
+        stages = snapshot['stages']
+        names = [name for name in self.STAGES if name in stages] + [name for name in stages if name not in self.STAGES]
+        self.table.setRowCount(len(names))
+        self.table.setVerticalHeaderLabels(names)
+        for row, name in enumerate(names):
+            for column, stat in enumerate(self.COLUMNS):
+                value = stages[name][stat]
+                text = '' if value is None else str(value) if stat == 'count' else '%.3g' % value
+                self.table.setItem(row, column, QTableWidgetItem(text))
+
+    def reset(self):
+        self.controller.metrics.reset()
+        self.update()
+
+    def save(self):
+        path, selected = QFileDialog.getSaveFileName(self, 'Save performance trace', '',
+                                                     'JSON (*.json);;CSV (*.csv)')
+        if path:
+            self.controller.metrics.saveTrace(path)
+
+    def enabled(self, bool):
+        # Stays live while scanning and acquiring
         pass
 
 
@@ -385,6 +566,35 @@ class PlotPatternWidget(PyQtG.PlotWidget):
         pass
 
 
+class MotionPlotWidget(PyQtG.PlotWidget):
+    """
+    Accumulated axial and lateral displacement of the X and Y B-scans over time
+    """
+
+    def __init__(self, name):
+
+        super().__init__(name=name)
+
+        self.setTitle(title=name)
+        self.showGrid(x=1, y=1)
+        self.setLabels(left='um', bottom='s')
+        self.addLegend(offset=(10, 10))
+        # B-scan 1 is X and B-scan 0 is Y, as in the B-scan display
+        self.curves = {
+            ('axial', 1): self.plot(pen=PyQtG.mkPen(color=(255, 120, 120)), name='X axial'),
+            ('axial', 0): self.plot(pen=PyQtG.mkPen(color=(120, 170, 255)), name='Y axial'),
+            ('lateral', 1): self.plot(pen=PyQtG.mkPen(color=(255, 200, 120)), name='X lateral'),
+            ('lateral', 0): self.plot(pen=PyQtG.mkPen(color=(120, 255, 200)), name='Y lateral')
+        }
+
+    def plotTraces(self, t, axial, lateral):
+        for (kind, b), curve in self.curves.items():
+            curve.setData(x=t, y=(axial if kind == 'axial' else lateral)[:, b])
+
+    def enabled(self, bool):
+        pass
+
+
 class PlotWidget2D(PyQtG.PlotWidget):
 
     def __init__(self, type='curve', name=None, xaxis=np.arange(2048), aspectLocked=False):
@@ -438,8 +648,16 @@ class BScanView(PyQtG.GraphicsLayoutWidget):  # Doesn't work for some reason. TO
 
 
 class BScanViewer(PyQtG.ImageView):
+    """
+    Displays complex B-scans in dB with a fixed window. Complex pixels are mapped to 8-bit through a table of the fixed
+    window precomputed for every float32 power, into a preallocated buffer, so that each frame only replaces the pixels
+    of the existing ImageItem instead of clearing the view and having it rescale and histogram a float image.
+    """
 
-    def __init__(self):
+    def __init__(self, levels=(-100, -2)):
+        """
+        :param levels: dB mapped to black and white
+        """
 
         super().__init__()
 
@@ -447,9 +665,68 @@ class BScanViewer(PyQtG.ImageView):
         self.ui.roiBtn.hide()
         self.ui.menuBtn.hide()
 
-    def update(self,data):
-        self.clear()
-        self.setImage(data, autoLevels=False, levels=(-100, -2))
+        # The hidden histogram would otherwise be recomputed from every new image
+        self.imageItem.sigImageChanged.disconnect(self.ui.histogram.imageChanged)
+
+        self.imageItem.axisOrder = 'row-major'  # B-scans are [z, x]
+
+        self._levels = levels
+        self._table = generateDecibelTable(levels)
+        self._magnitude = None
+        self._pixels = None
+        self._metrics = None
+
+    def setMetrics(self, metrics):
+        """
+        :param metrics: PipelineMetrics the log scaling and render stages are timed into, or None
+        """
+        self._metrics = metrics
+
+    def update(self, bscan):
+        """
+        :param bscan: Complex B-scan [z, x]
+        """
+        start = time.perf_counter()
+        first = self._allocate(bscan.shape)
+        quantizeDecibels(bscan, self._table, self._pixels)
+        self._draw(first, start)
+
+    def updateScalar(self, image, levels):
+        """
+        Displays a real image, such as flow contrast, on a linear scale
+        :param image: Real image [z, x]
+        :param levels: Values mapped to black and white
+        """
+        start = time.perf_counter()
+        first = self._allocate(image.shape)
+        np.subtract(image, levels[0], out=self._magnitude, casting='unsafe')
+        np.multiply(self._magnitude, 255 / (levels[1] - levels[0]), out=self._magnitude)
+        np.clip(self._magnitude, 0, 255, out=self._magnitude)
+        np.copyto(self._pixels, self._magnitude, casting='unsafe')
+        self._draw(first, start)
+
+    def _allocate(self, shape):
+        # Returns True if the buffers were reallocated for a new shape
+        if self._pixels is not None and self._pixels.shape == shape:
+            return False
+        self._magnitude = np.empty(shape, dtype=np.float32)
+        self._pixels = np.empty(shape, dtype=np.uint8)
+        return True
+
+    def _draw(self, first, start):
+        # Draws the 8-bit image in _pixels
+        if self._metrics is not None:
+            start = self._metrics.record('log', start)
+
+        if first:
+            # Sets up the view range for the new shape. Without levels, the 8-bit pixels are drawn as a grayscale
+            # image directly
+            self.setImage(self._pixels, autoLevels=False, levels=(0, 255))
+            self.imageItem.setLevels(None)
+        else:
+            self.imageItem.updateImage(self._pixels)
+        if self._metrics is not None:
+            self._metrics.record('render', start)
 
     def enabled(self, bool):
-        pass
\ No newline at end of file
+        pass
@@ -1,3 +1,6 @@
+import time
+startTime = time.perf_counter()  # For the time to first window
+
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtWidgets import QWidget
@@ -5,6 +8,7 @@ from PyQt5.QtWidgets import QTabWidget
 from PyQt5.QtWidgets import QGridLayout
 
 import sys
+import multiprocessing
 
 from PyQt5 import QtCore
 
@@ -21,8 +25,8 @@ if hasattr(QtCore.Qt, 'AA_UseHighDpiPixmaps'):
 
 QtInstance = QtCore.QCoreApplication.instance()
 
-# Supposed to allow IPython kernal to recover from closing of app
-if QtInstance is None:
+# Supposed to allow IPython kernal to recover from closing of app. Not needed in export worker processes
+if QtInstance is None and __name__ != '__mp_main__':
     QtInstance = QApplication(sys.argv)
 
 class Main(QTabWidget):
@@ -52,8 +56,11 @@ class Main(QTabWidget):
 
 # Qt main loop
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # Export worker processes of the frozen app
     appctxt = ApplicationContext()
     window = Main()
     window.show()
+    QtCore.QTimer.singleShot(0, lambda: print('Window shown ' + str(time.perf_counter() - startTime)[0:5] +
+                                              ' s after start'))  # Runs once the event loop has drawn it
     exit_code = appctxt.app.exec_()
     sys.exit(exit_code)